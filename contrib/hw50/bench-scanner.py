@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+#
+# Benchmark of the HW50 frame scanner in lumina.plugins.hw50.
+#
+# Replays a recorded serial capture through the scanner in chunks, the way
+# it arrives from the serial port. A capture can be recorded on target with
+#     socat -u /dev/ttyUSB0,b38400,parenb,raw - >hw50.raw
+#
+# If no capture is given, a synthetic stream of frames interleaved with
+# junk is generated.
+#
+from __future__ import absolute_import, division, print_function
+
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from lumina.plugins.hw50 import FrameScanner, encode_hw50frame
+from lumina.plugins.hw50 import STATUS_POWER, GET_RS, SOF, EOF
+
+
+class NullLog(object):
+    ''' Logger discarding everything '''
+    def info(self, *args, **kw):
+        pass
+    debug = info
+
+
+def synthetic_stream(count, junk):
+    ''' Return a stream of count frames with up to junk bytes of random
+        data between them. The junk also contains SOF and EOF bytes.
+    '''
+    rnd = random.Random(0)
+    noise = bytearray(rnd.choice((SOF, EOF, 0x00, 0x55, 0xff)) for _ in range(4096))
+    data = bytearray()
+    for i in range(count):
+        n = rnd.randint(0, junk)
+        pos = rnd.randint(0, len(noise) - n)
+        data += noise[pos:pos+n]
+        data += encode_hw50frame(STATUS_POWER, GET_RS, i & 0xFFFF)
+    return bytes(data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='HW50 frame scanner benchmark')
+    parser.add_argument('file', nargs='?', help='Recorded serial capture')
+    parser.add_argument('-n', '--frames', type=int, default=100000,
+                        help='Number of synthetic frames (default %(default)s)')
+    parser.add_argument('-j', '--junk', type=int, default=16,
+                        help='Max junk bytes between synthetic frames (default %(default)s)')
+    parser.add_argument('-c', '--chunk', type=int, default=64,
+                        help='Bytes per received chunk (default %(default)s)')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='Number of runs (default %(default)s)')
+    opts = parser.parse_args()
+
+    if opts.file:
+        with open(opts.file, 'rb') as f:
+            data = f.read()
+    else:
+        data = synthetic_stream(opts.frames, opts.junk)
+
+    chunks = [data[i:i+opts.chunk] for i in range(0, len(data), opts.chunk)]
+    print("%s bytes in %s chunks of %s bytes" %(len(data), len(chunks), opts.chunk))
+
+    for run in range(opts.repeat):
+        scanner = FrameScanner(NullLog())
+        count = 0
+        start = time.time()
+        for chunk in chunks:
+            count += len(scanner.feed(chunk))
+        elapsed = time.time() - start
+        print("Run %s: %s frames in %.3fs, %.0f bytes/s" %(
+            run+1, count, elapsed, len(data)/elapsed if elapsed else 0))
+
+
+if __name__ == '__main__':
+    main()
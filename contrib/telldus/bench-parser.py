@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+#
+# Benchmark of the Telldus event stream parser in lumina.plugins.telldus.
+#
+# Replays a recorded TelldusEvents stream through the parser in chunks, the
+# way it arrives from the socket. A stream can be recorded on target with
+#     socat UNIX-connect:/tmp/TelldusEvents - >events.raw
+#
+# If no recording is given, a synthetic stream is generated.
+#
+from __future__ import absolute_import, division, print_function
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from lumina.plugins.telldus import TelldusParser, generate
+
+
+def synthetic_stream(count):
+    ''' Return a stream of count events of mixed types '''
+    events = [
+        ['TDRawDeviceEvent',
+         'class:command;protocol:arctech;model:selflearning;house:14378530;unit:1;group:0;method:turnon;', 1],
+        ['TDRawDeviceEvent',
+         'class:sensor;protocol:mandolyn;id:11;model:temperaturehumidity;temp:4.2;humidity:80;', 1],
+        ['TDSensorEvent', 'mandolyn', 'temperaturehumidity', 11, 1, '4.2', 1496849341],
+        ['TDDeviceEvent', 105, 1, ''],
+    ]
+    return b''.join(generate(events[i % len(events)]).encode('ascii')
+                    for i in range(count))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Telldus parser benchmark')
+    parser.add_argument('file', nargs='?', help='Recorded TelldusEvents stream')
+    parser.add_argument('-n', '--events', type=int, default=100000,
+                        help='Number of synthetic events (default %(default)s)')
+    parser.add_argument('-c', '--chunk', type=int, default=4096,
+                        help='Bytes per received chunk (default %(default)s)')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='Number of runs (default %(default)s)')
+    opts = parser.parse_args()
+
+    if opts.file:
+        with open(opts.file, 'rb') as f:
+            data = f.read()
+    else:
+        data = synthetic_stream(opts.events)
+
+    chunks = [data[i:i+opts.chunk] for i in range(0, len(data), opts.chunk)]
+    print("%s bytes in %s chunks of %s bytes" %(len(data), len(chunks), opts.chunk))
+
+    for run in range(opts.repeat):
+        stream = TelldusParser()
+        count = 0
+        start = time.time()
+        for chunk in chunks:
+            stream.feed(chunk)
+            for event in stream.events():  # pylint: disable=unused-variable
+                count += 1
+        elapsed = time.time() - start
+        print("Run %s: %s events in %.3fs, %.0f events/s" %(
+            run+1, count, elapsed, count/elapsed if elapsed else 0))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+# -*- python -*-
+""" Command queue with priority lanes """
+from __future__ import absolute_import, division, print_function
+
+from collections import deque
+
+
+# Priority lanes. Lower numbers are served first.
+PRIO_HIGH = 0
+PRIO_NORMAL = 1
+PRIO_LOW = 2
+
+# Overflow policies, see CommandQueue
+OVERFLOW_REJECT = 'reject'
+OVERFLOW_DROP_OLDEST = 'drop_oldest'
+
+
+class CommandQueue(object):
+    ''' A FIFO queue with priority lanes for pending commands. It is intended
+        to be used from the reactor thread only, and does no locking. Items
+        are returned from the highest priority non-empty lane first, in the
+        order they were put.
+
+        The queue can be bounded by 'maxsize'. When full, the 'overflow'
+        policy decides which item is dropped:
+
+          reject       The new item is dropped.
+          drop_oldest  The oldest item of the lowest priority lane is
+                       dropped, unless the new item has lower priority.
+
+        The dropped item is passed to the 'dropped' callback, which is
+        responsible for failing it.
+    '''
+
+    def __init__(self, reactor, maxsize=None, overflow=OVERFLOW_REJECT,
+                 dropped=None, lanes=PRIO_LOW+1):
+        if overflow not in (OVERFLOW_REJECT, OVERFLOW_DROP_OLDEST):
+            raise ValueError("Unknown overflow policy '%s'" %(overflow,))
+        self.reactor = reactor
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.dropped = dropped
+        self.lanes = [deque() for _ in range(lanes)]
+        self.size = 0
+
+        # Metrics
+        self.peak = 0
+        self.n_put = 0
+        self.n_dropped = 0
+        self.n_get = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+
+    def __len__(self):
+        return self.size
+
+
+    def put(self, item, priority=PRIO_NORMAL):
+        ''' Add item to the queue lane given by priority. Returns False if the
+            item was dropped due to overflow.
+        '''
+        lane = self.lanes[priority]
+        self.n_put += 1
+
+        if self.maxsize is not None and self.size >= self.maxsize:
+            victim = None
+            if self.overflow == OVERFLOW_DROP_OLDEST:
+                for prio in range(len(self.lanes)-1, priority-1, -1):
+                    if self.lanes[prio]:
+                        victim = self.lanes[prio]
+                        break
+            if victim is None:
+                self.drop(item)
+                return False
+            self.size -= 1
+            self.drop(victim.popleft()[0])
+
+        lane.append((item, self.reactor.seconds()))
+        self.size += 1
+        if self.size > self.peak:
+            self.peak = self.size
+        return True
+
+
+    def get(self):
+        ''' Remove and return the next item. Raises IndexError if the queue is
+            empty.
+        '''
+        for lane in self.lanes:
+            if lane:
+                (item, queued) = lane.popleft()
+                self.size -= 1
+
+                wait = self.reactor.seconds() - queued
+                self.n_get += 1
+                self.wait_total += wait
+                if wait > self.wait_max:
+                    self.wait_max = wait
+                return item
+        raise IndexError("get from an empty queue")
+
+
+    def peek(self):
+        ''' Return the next item without removing it. Raises IndexError if
+            the queue is empty.
+        '''
+        for lane in self.lanes:
+            if lane:
+                return lane[0][0]
+        raise IndexError("peek from an empty queue")
+
+
+    def clear(self):
+        ''' Remove all items. Returns the list of removed items. '''
+        items = [item for lane in self.lanes for (item, queued) in lane]
+        for lane in self.lanes:
+            lane.clear()
+        self.size = 0
+        return items
+
+
+    def drop(self, item):
+        ''' Handle an item dropped due to overflow '''
+        self.n_dropped += 1
+        if self.dropped is not None:
+            self.dropped(item)
+
+
+    def stats(self):
+        ''' Return a dict of the queue metrics '''
+        return {
+            'depth'    : self.size,
+            'lanes'    : [len(lane) for lane in self.lanes],
+            'maxsize'  : self.maxsize,
+            'peak'     : self.peak,
+            'put'      : self.n_put,
+            'dropped'  : self.n_dropped,
+            'wait_avg' : self.wait_total / self.n_get if self.n_get else 0.0,
+            'wait_max' : self.wait_max,
+        }
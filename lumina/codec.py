@@ -0,0 +1,179 @@
+# -*- python -*-
+""" Lumina wire codecs """
+from __future__ import absolute_import, division, print_function
+
+import struct
+
+from lumina.message import Message
+
+
+# MessagePack and CBOR are optional. JSON is always available.
+MSGPACK_IMPORTED = True
+try:
+    import msgpack
+except ImportError:
+    MSGPACK_IMPORTED = False
+
+CBOR_IMPORTED = True
+try:
+    import cbor2
+except ImportError:
+    CBOR_IMPORTED = False
+
+
+# Binary frames are prefixed by a 32-bit big endian payload length. A zero
+# length frame is used as keepalive.
+FRAME_HEADER = struct.Struct('!I')
+
+# Largest frame accepted from peer. Anything larger is considered a
+# corrupt stream.
+MAX_FRAME_SIZE = 1024*1024
+
+
+
+def encode_default(obj):
+    ''' Encoder hook for objects the binary packers can't handle natively '''
+    if isinstance(obj, Message):
+        return obj.dump_dict()
+    raise TypeError("Object of type '%s' cannot be encoded" %(type(obj).__name__,))
+
+
+
+class JsonCodec(object):
+    ''' Newline delimited JSON codec. This is the default codec and the only
+        codec understood by older peers. Framing is done by the LineReceiver
+        in LuminaProtocol, so unframe() is never used for this codec.
+    '''
+    name = 'json'
+    framed = False
+
+    def encode(self, message):
+        ''' Return the wire representation of message '''
+        return message.dump_json() + '\n'
+
+    def decode(self, data):
+        ''' Return a new Message() from a single frame payload '''
+        return Message.create_from_json(data)
+
+    def keepalive(self):
+        ''' Return an empty keepalive frame '''
+        return '\n'
+
+
+
+class LengthPrefixedCodec(object):
+    ''' Base class for binary codecs using length-prefixed frames. The
+        inheriting classes must implement dumps() and loads().
+    '''
+    name = None
+    framed = True
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def dumps(self, obj):
+        raise NotImplementedError()
+
+    def loads(self, data):
+        raise NotImplementedError()
+
+    def encode(self, message):
+        ''' Return the wire representation of message '''
+        payload = self.dumps(message.dump_dict())
+        return FRAME_HEADER.pack(len(payload)) + payload
+
+    def decode(self, data):
+        ''' Return a new Message() from a single frame payload '''
+        obj = self.loads(data)
+        if not isinstance(obj, dict):
+            raise ValueError("Frame payload is not a dict")
+        return Message.create_from_dict(obj)
+
+    def keepalive(self):
+        ''' Return an empty keepalive frame '''
+        return FRAME_HEADER.pack(0)
+
+    def unframe(self, data):
+        ''' Append data to the receive buffer and return a list of the
+            complete frame payloads found. Empty keepalive frames are
+            not returned.
+        '''
+        buf = self.buffer
+        buf += data
+        offset = 0
+        frames = []
+        while len(buf) - offset >= FRAME_HEADER.size:
+            (length,) = FRAME_HEADER.unpack_from(buf, offset)
+            if length > MAX_FRAME_SIZE:
+                raise ValueError("Frame length %s exceeds max frame size" %(length,))
+            end = offset + FRAME_HEADER.size + length
+            if len(buf) < end:
+                break
+            if length:
+                frames.append(bytes(buf[offset + FRAME_HEADER.size:end]))
+            offset = end
+
+        # Consume the processed frames in one operation
+        del buf[:offset]
+        return frames
+
+
+
+class MsgpackCodec(LengthPrefixedCodec):
+    ''' MessagePack codec '''
+    name = 'msgpack'
+
+    def dumps(self, obj):
+        return msgpack.packb(obj, default=encode_default, use_bin_type=True)
+
+    def loads(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+
+
+class CborCodec(LengthPrefixedCodec):
+    ''' CBOR codec '''
+    name = 'cbor'
+
+    def dumps(self, obj):
+        return cbor2.dumps(obj, default=lambda encoder, value:
+                           encoder.encode(encode_default(value)))
+
+    def loads(self, data):
+        return cbor2.loads(data)
+
+
+
+# Available codecs in order of preference
+CODECS = []
+if MSGPACK_IMPORTED:
+    CODECS.append(MsgpackCodec)
+if CBOR_IMPORTED:
+    CODECS.append(CborCodec)
+CODECS.append(JsonCodec)
+
+
+
+def codec_names():
+    ''' Return the list of the names of the available codecs in order of
+        preference
+    '''
+    return [cls.name for cls in CODECS]
+
+
+def get_codec(name):
+    ''' Return a new codec instance of the given name '''
+    for cls in CODECS:
+        if cls.name == name:
+            return cls()
+    raise ValueError("Unknown codec '%s'" %(name,))
+
+
+def select_codec(names):
+    ''' Return a new instance of the most preferred codec which is also
+        present in names. JSON is returned if nothing else matches.
+    '''
+    for cls in CODECS:
+        if cls.name in names:
+            return cls()
+    return JsonCodec()
@@ -7,8 +7,10 @@ import sys
 # Python 3 compatibility
 if sys.version_info < (3, 0):
     STRTYPE = unicode
+    INTERN = intern
 else:
     STRTYPE = str
+    INTERN = sys.intern
 
 
 def compat_itervalues(dictionary, **kwargs):
@@ -17,3 +19,26 @@ def compat_itervalues(dictionary, **kwargs):
         return dictionary.itervalues(**kwargs)
     except AttributeError:
         return dictionary.values(**kwargs)
+
+
+def compat_str(data):
+    """ Return bytes data as the native str type. It is returned as is on
+        Python 2.
+    """
+    if isinstance(data, str):
+        return data
+    return data.decode('utf-8', 'replace')
+
+
+def compat_intern(string):
+    """ Compatibility string interning. Returns string as is if it
+        cannot be interned.
+    """
+    try:
+        return INTERN(string)
+    except TypeError:
+        # Py2 does not intern unicode, so try the ascii str equivalent
+        try:
+            return INTERN(string.encode('ascii'))
+        except (AttributeError, UnicodeError):
+            return string
@@ -46,6 +46,9 @@ class Config(object):
     def __init__(self):
         self.config = {}
 
+        # Incremented on every change of the configuration
+        self.version = 0
+
 
     def update_v(self, k):
         ''' Update the key value
@@ -60,6 +63,7 @@ class Config(object):
         else:
             raise KeyError(k)
         self.config[k]['v'] = v
+        self.version += 1
         return v
 
 
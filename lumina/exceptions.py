@@ -36,3 +36,6 @@ class ConfigException(LuminaException):
 
 class NoConnectionException(LuminaException):
     ''' Connection errors '''
+
+class QueueFullException(LuminaException):
+    ''' Command dropped due to full queue '''
@@ -6,22 +6,26 @@ logging.
 from __future__ import absolute_import, division, print_function
 
 import sys
+import atexit
+import threading
+from collections import deque
 
 from zope.interface import implementer
-from twisted.logger import Logger
+from twisted.logger import Logger as TwistedLogger
 from twisted.logger import ILogObserver
 from twisted.logger import formatTime
 from twisted.logger import formatEvent
 from twisted.logger import globalLogBeginner
 from twisted.logger import globalLogPublisher
-from twisted.logger import FileLogObserver
 from twisted.logger import FilteringLogObserver
 from twisted.logger import LogLevelFilterPredicate
 from twisted.logger import LogLevel
 from twisted.logger import ILogFilterPredicate
 from twisted.logger import PredicateResult
+from twisted.logger import InvalidLogLevelError
 
 from lumina.compat import STRTYPE
+from lumina.exceptions import CommandParseException, ConfigException
 
 
 # Some architectures does not support syslog
@@ -31,7 +35,12 @@ try:
 except ImportError:
     SYSLOG_IMPORTED = False
 
-__all__ = ["start", "Logger", "LogLevel"]
+__all__ = ["start", "Logger", "LogLevel", "isEnabled", "setLogLevels", "logLevelCommand",
+           "logHistoryCommand"]
+
+# The active log filter and writer, set by start()
+_predicate = None
+_writer = None
 
 
 
@@ -74,9 +83,35 @@ log_specials = {
 }
 
 
+class LazySpecial(object):
+    ''' A special log variable which is formatted when it is used '''
+    __slots__ = ('fn', 'value', 'text')
+
+    def __init__(self, fn, value):
+        self.fn = fn
+        self.value = value
+        self.text = None
+
+    def __str__(self):
+        if self.text is None:
+            self.text = self.fn(self.value)
+        return self.text
+
+    def __format__(self, spec):
+        return format(str(self), spec)
+
+
+
 @implementer(ILogObserver)
 class LuminaLogFormatter(object):
-    ''' Logging observer for Lumina '''
+    ''' Logging observer for Lumina. It prepares the events for output
+        and passes them on to observer. It is intended to run after the
+        filtering, so only the emitted events are prepared.
+    '''
+
+    def __init__(self, observer):
+        self.observer = observer
+
 
     def __call__(self, event):
         ''' Main dispatcher for log-events '''
@@ -100,13 +135,13 @@ class LuminaLogFormatter(object):
 
         # It works by seraching if any of the special variables are
         # present in the event. If it is, the given print function is
-        # run and the variable is stored in _name. This can then be
-        # accessed from the logged text by using {_name}.
+        # stored in _name, and is run when the logged text access it by
+        # using {_name}.
 
         #fmt = event['log_format']
         for (var, fn) in log_specials.items():
             if var in event:
-                event['_' + var] = fn(event[var])
+                event['_' + var] = LazySpecial(fn, event[var])
 
                 # If the special var is not present in the
                 # format string, add it to the end
@@ -128,11 +163,108 @@ class LuminaLogFormatter(object):
             event['log_text'] = u"\n".join((eventText, traceback))
             event['log_format'] = '{log_text}'
 
+        self.observer(event)
+
+
+
+class FileLogSink(object):
+    ''' Log output to a file, for use with BufferedLogObserver '''
+
+    def __init__(self, outFile, formatEvent=formatLuminaLogText):
+        self.outFile = outFile
+        self.formatEvent = formatEvent
+
+    def format(self, event):
+        return self.formatEvent(event)
+
+    def text(self, record):
+        return record
+
+    def write(self, records):
+        self.outFile.write(u"".join(records))
+        self.outFile.flush()
+
+
+
+@implementer(ILogObserver)
+class BufferedLogObserver(object):
+    ''' Log observer which writes the events from a background thread, so
+        slow writes do not stall the reactor. The events are formatted into
+        records by the sink on the calling thread, and are written in batches
+        by the writer thread. If the writer falls behind, the oldest records
+        are dropped when there are more than 'maxlen' records waiting. The
+        last 'history' records are kept for inspection.
+    '''
+
+    def __init__(self, sink, maxlen=1000, history=200):
+        self.sink = sink
+        self.maxlen = maxlen
+        self.queue = deque()
+        self.history = deque(maxlen=history)
+        self.dropped = 0
+        self.errors = 0
+        self.running = True
+        self.lock = threading.Condition()
+        self.thread = threading.Thread(target=self.run, name='logwriter')
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    def __call__(self, event):
+        record = self.sink.format(event)
+        if record is None:
+            return
+        self.history.append(record)
+        with self.lock:
+            if len(self.queue) >= self.maxlen:
+                self.queue.popleft()
+                self.dropped += 1
+            self.queue.append(record)
+            self.lock.notify()
+
+
+    def run(self):
+        ''' The writer thread '''
+        while True:
+            with self.lock:
+                while self.running and not self.queue:
+                    self.lock.wait()
+                if not self.queue:
+                    return
+                records = list(self.queue)
+                self.queue.clear()
+            try:
+                self.sink.write(records)
+            except Exception:  # pylint: disable=broad-except
+                # There is nowhere to log this
+                self.errors += 1
+
+
+    def stop(self, timeout=2.0):
+        ''' Write the remaining records and stop the writer thread '''
+        with self.lock:
+            self.running = False
+            self.lock.notify()
+        self.thread.join(timeout)
+
+
+    def getHistory(self, count=None):
+        ''' Return the text of the last count records '''
+        records = list(self.history)
+        if count is not None:
+            records = records[-count:] if count > 0 else []
+        return [self.sink.text(record) for record in records]
+
 
 
 @implementer(ILogFilterPredicate)
 class LuminaFilterPredicate(object):
-    ''' Log filter engine '''
+    ''' Log filter engine. The minimum log level can be set by namespace,
+        either by the exact name, e.g. 'telldus/in', or by a prefix ending
+        with '*', e.g. 'server:*'. The longest matching prefix is used. The
+        namespaces which are not set use the global minimum log level and
+        the default filtering of noisy messages.
+    '''
 
     # Lazy shortcuts
     yes = PredicateResult.yes
@@ -145,24 +277,83 @@ class LuminaFilterPredicate(object):
             overall minimum log-level
         '''
         self.minLoglevel = minimumLoglevel
+        self.levels = {}
+        self.prefixes = []
+
+        # Resolved level by namespace, None if not set
+        self.cache = {}
+
+
+    def setLogLevel(self, namespace, level):
+        ''' Set the minimum log level of namespace, or the namespaces starting
+            with the prefix if it ends with '*'. A level of None removes it.
+        '''
+        if level is None:
+            self.levels.pop(namespace, None)
+        else:
+            self.levels[namespace] = level
+        self.prefixes = sorted(((k[:-1], v) for (k, v) in self.levels.items() if k.endswith('*')),
+                               key=lambda p: len(p[0]), reverse=True)
+        self.cache = {}
+
+
+    def getLogLevels(self):
+        ''' Return the dict of set log levels by name '''
+        return {k: v.name for (k, v) in self.levels.items()}
+
+
+    def getLogLevel(self, namespace):
+        ''' Return the minimum log level of namespace, or None if it is not
+            set
+        '''
+        try:
+            return self.cache[namespace]
+        except KeyError:
+            pass
+
+        level = self.levels.get(namespace)
+        if level is None:
+            for (prefix, plevel) in self.prefixes:
+                if namespace.startswith(prefix):
+                    level = plevel
+                    break
+        self.cache[namespace] = level
+        return level
 
 
     def __call__(self, event):
         ''' Run the filtertest on the event '''
 
-        # FIXME: This should be far more configurable
-
         # Handle message without log_level
-        if not event.get('log_level', None):
+        log_level = event.get('log_level', None)
+        if not log_level:
             return self.yes
 
-        log_level = event.get('log_level')
+        return self.check(event.get('log_namespace', ''), log_level, event)
+
+
+    def isEnabled(self, namespace, log_level, specials=()):
+        ''' Return True if events of log_level on namespace, with the given
+            special variables, might be emitted
+        '''
+        return self.check(namespace, log_level, specials) is not self.no
+
+
+    def check(self, namespace, log_level, event):
+        ''' Run the filtertest. 'event' is the event or the names of the
+            variables in it.
+        '''
 
         # Important messages goes through always
         if log_level >= LogLevel.error:
             return self.yes
 
-        namespace = event.get('log_namespace', '')
+        # Namespaces with a set level are not filtered further
+        level = self.getLogLevel(namespace)
+        if level is not None:
+            if log_level < level:
+                return self.no
+            return self.maybe
 
         # Filter out all RAW packages
         if 'rawin' in event or 'rawout' in event:
@@ -184,9 +375,82 @@ class LuminaFilterPredicate(object):
 
 
 
+class Logger(TwistedLogger):
+    ''' Logger with a check of the log level, which can be used to skip
+        building expensive log arguments.
+    '''
+
+    def isEnabled(self, level, *specials):
+        ''' Return True if an event of level with the given special
+            variables might be emitted from this logger
+        '''
+        return isEnabled(self.namespace, level, *specials)
+
+
+
+def isEnabled(namespace, level, *specials):
+    ''' Return True if an event of level on namespace, with the given
+        special variables, might be emitted. Everything is enabled until
+        the logging has been started.
+    '''
+    if _predicate is None:
+        return True
+    return _predicate.isEnabled(namespace, level, specials)
+
+
+
+def setLogLevels(levels):
+    ''' Set the minimum log levels from the dict of namespace: level name '''
+    if _predicate is None:
+        return
+    for (namespace, name) in levels.items():
+        try:
+            level = LogLevel.levelWithName(name)
+        except InvalidLogLevelError:
+            raise ConfigException("Unknown log level '%s' for '%s'" %(name, namespace))
+        _predicate.setLogLevel(namespace, level)
+
+
+
+def logLevelCommand(namespace=None, name=None):
+    ''' Handler for the _loglevel commands. Set the log level name of
+        namespace, or remove it if name is not given. Returns the dict of
+        set log levels.
+    '''
+    if _predicate is None:
+        return {}
+    if namespace is not None:
+        level = None
+        if name is not None:
+            try:
+                level = LogLevel.levelWithName(name)
+            except InvalidLogLevelError:
+                raise CommandParseException("Unknown log level '%s'" %(name,))
+        _predicate.setLogLevel(namespace, level)
+    return _predicate.getLogLevels()
+
+
+
+def logHistoryCommand(count=None):
+    ''' Handler for the _log commands. Returns the last count log messages
+        and the log writer metrics.
+    '''
+    if _writer is None:
+        return {}
+    if count is not None:
+        count = int(count)
+    return {
+        'dropped'  : _writer.dropped,
+        'errors'   : _writer.errors,
+        'messages' : _writer.getHistory(count),
+    }
+
+
+
 def start(syslog=False, logfile=None, syslog_prefix='lumina', redirect_stdio=False,
-          loglevel=None):
+          loglevel=None, buffer_size=1000, history_size=200):
     ''' Start the custom logger '''
+    global _predicate, _writer  # pylint: disable=W0603
 
     # System defaults from twisted.logger._global.py:
     #   globalLogPublisher = LogPublisher()
@@ -198,21 +462,24 @@ def start(syslog=False, logfile=None, syslog_prefix='lumina', redirect_stdio=Fal
     if loglevel is None:
         loglevel = LogLevel.info
 
-    # Lumina log observers
+    # Lumina log observers. The output is written from a background thread.
     if syslog and SYSLOG_IMPORTED:
-        out_observer = SyslogObserver(prefix=syslog_prefix)
+        sink = SyslogObserver(prefix=syslog_prefix)
     else:
-        out_observer = FileLogObserver(sys.stdout, formatLuminaLogText)
+        sink = FileLogSink(logfile)
+    _writer = BufferedLogObserver(sink, maxlen=buffer_size, history=history_size)
+    atexit.register(_writer.stop)
 
     #level_filter = LogLevelFilterPredicate(defaultLogLevel=loglevel)
     #level_filter.setLogLevelForNamespace('server', LogLevel.warn)
 
+    # Filter before formatting, as most debug events are never emitted
+    _predicate = LuminaFilterPredicate(minimumLoglevel=loglevel)
     observers = (
-        LuminaLogFormatter(),
         FilteringLogObserver(
-            out_observer,
+            LuminaLogFormatter(_writer),
             [ #level_filter,
-                LuminaFilterPredicate(minimumLoglevel=loglevel),
+                _predicate,
             ]
         ),
     )
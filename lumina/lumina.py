@@ -10,10 +10,10 @@ from importlib import import_module
 from datetime import datetime
 
 import lumina
-from lumina.log import Logger
-from lumina.state import ColorState
+from lumina.log import Logger, setLogLevels
+from lumina.state import ColorState, ColorStateAggregate
 from lumina.plugin import Plugin
-from lumina.utils import topolgical_sort
+from lumina.utils import topolgical_sort, Snapshot
 from lumina.message import Message
 from lumina.compat import compat_itervalues
 
@@ -30,6 +30,8 @@ class Lumina(object):
         'conffile'   : dict(default='lumina.json', help='Configuration file'),
         'plugins'    : dict(default=[], help='Plugins to load', type=list),
         'hostid'     : dict(default=socket.gethostname(), help='Unique id for this host'),
+        'loglevels'  : dict(default={}, help='Minimum log level by namespace, '
+                            "e.g. {'server:*': 'info'}", type=dict),
     }
 
     # Default return value
@@ -44,10 +46,12 @@ class Lumina(object):
 
         self.log = Logger(namespace='-')
         self.status = ColorState(log=self.log)
+        self.plugin_states = ColorStateAggregate()
 
         # Configuration
         self.config = config
         config.add_templates(self.GLOBAL_CONFIG)
+        setLogLevels(config.get('loglevels'))
 
         # General info
         self.hostname = socket.gethostname()
@@ -61,6 +65,10 @@ class Lumina(object):
         self.log.info("Host {host} [{hostid}], PID {pid}",
                       host=self.hostname, hostid=self.hostid, pid=self.pid)
 
+        # Cached info, rebuilt when plugins, status or config changes
+        self.info_version = 0
+        self.info = Snapshot(self.build_info, self.get_info_version)
+
 
     def run(self):
         ''' Run the engine by loading plugins '''
@@ -182,11 +190,14 @@ class Lumina(object):
         # Give reference to us (FIXME, shouldn't inject references like this)
         plugin.master = self
 
-        # Update status
-        plugin.status.add_callback(self.update_status, run_now=True)
-
         # Register plugin
         self.plugins[name] = plugin
+        self.info_version += 1
+
+        # Update status
+        self.plugin_states.add(plugin.status)
+        plugin.status.add_callback(self.update_status)
+        self.status.set(*self.plugin_states.combine())
 
         # Copy the plugin dependencies
         deps = plugin.DEPENDS
@@ -238,8 +249,9 @@ class Lumina(object):
     #== INTERNAL FUNCTIONS
     def update_status(self, status):  # pylint: disable=W0613
         ''' Callback updating the status from all plugins '''
-        (state, why) = ColorState.combine(*[plugin.status for plugin in compat_itervalues(self.plugins)])
-        self.status.set(state, why)
+        self.info_version += 1
+        if self.plugin_states.update(status):
+            self.status.set(*self.plugin_states.combine())
 
 
     #== SERVICE FUNCTIONS
@@ -257,8 +269,20 @@ class Lumina(object):
                 return inst
 
 
+    def get_info_version(self):
+        ''' Return the version of the info '''
+        return (self.info_version, self.config.version)
+
+
     def get_info(self):
-        ''' Return a dict of info about this server '''
+        ''' Return a dict of info about this server. The dict is cached and
+            must not be modified.
+        '''
+        return self.info.get()
+
+
+    def build_info(self):
+        ''' Build the dict of info about this server '''
         return {
             'hostname'   : self.hostname,
             'hostid'     : self.hostid,
@@ -274,7 +298,7 @@ class Lumina(object):
                     'status_why': plugin.status.why,
                 } for plugin in compat_itervalues(self.plugins)],
             'status'     : str(self.status),
-            'status_why' : self.status.why,
+            'status_why' : str(self.status.why) if self.status.why is not None else None,
             'config'     : [
                 {
                     'key'     : k,
@@ -296,6 +320,7 @@ class LuminaClient(Lumina):
         'conffile'   : dict(default='lumina.json', help='Configuration file'),
         'port'  : dict(default=5326, help='Lumina port to connect to', type=int),
         'server': dict(default='localhost', help='Lumina server to connect to'),
+        'loglevels': dict(default={}, help='Minimum log level by namespace', type=dict),
     }
 
 
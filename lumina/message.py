@@ -9,6 +9,7 @@ import shlex
 from twisted.python.failure import Failure
 
 from lumina.utils import str_object
+from lumina.compat import compat_intern
 from lumina.exceptions import NodeException
 
 
@@ -17,6 +18,66 @@ MAX_ELEMENTS = (5, 5)
 #MAX_ELEMENTS = (5, 5, 3)   # Useful in debug
 
 
+# Argument slot types, see compile_args()
+ARG_LITERAL = 0
+ARG_NAME = 1
+ARG_ALL = 2
+ARG_INDEX = 3
+ARG_INVALID = 4
+
+
+def compile_args(args):
+    ''' Compile a list of string arguments into a tuple of (type, value)
+        slots, which can be expanded against a message using expand_args().
+        The '$' arguments have the following meaning:
+           '$n'  name of the message
+           '$*'  all the arguments of the message
+           '$1'  the first argument of the message (and so on)
+    '''
+    slots = []
+    for arg in args:
+        if arg == '$*':
+            slots.append((ARG_ALL, None))
+        elif arg == '$n':
+            slots.append((ARG_NAME, None))
+        elif arg.startswith('$'):
+            index = arg[1:]
+            try:
+                slots.append((ARG_INDEX, (int(index)-1, index)))
+            except ValueError:
+                slots.append((ARG_INVALID, index))
+        else:
+            slots.append((ARG_LITERAL, arg))
+    return tuple(slots)
+
+
+def expand_args(name, slots, parse_name, parse_args):
+    ''' Return the tuple of arguments from the slots given by compile_args(),
+        where the '$' arguments are replaced with the name and arguments from
+        the parsed message. 'name' is only used in error messages.
+    '''
+    args = []
+    for (argtype, value) in slots:
+        if argtype == ARG_LITERAL:
+            args.append(value)
+        elif argtype == ARG_INDEX:
+            try:
+                args.append(parse_args[value[0]])
+            except IndexError:
+                raise IndexError(
+                    "%s argument index error '$%s', but message has %s args" %(
+                        name, value[1], len(parse_args)))
+        elif argtype == ARG_ALL:
+            args += parse_args
+        elif argtype == ARG_NAME:
+            args.append(parse_name)
+        else:
+            raise ValueError(
+                "%s argument value error '$%s'" %(name, value))
+    return tuple(args)
+
+
+
 class MessageEncoder(json.JSONEncoder):
     ''' Wrapper for JSON encoding of Message '''
     def default(self, obj):    # pylint: disable=E0202
@@ -33,9 +94,13 @@ class Message(object):
     type = 'message'
     want_response = False
 
+    # Messages are created and copied at a high rate, so keep them compact.
+    # Any inheriting classes must set __slots__ as well.
+    __slots__ = ('name', 'args', 'response', 'result', 'requestid', 'defer')
+
     def __init__(self, name=None, *args):
-        # Message data
-        self.name = name
+        # Message data. Message names are reused constantly, so intern them.
+        self.name = name if name is None else compat_intern(name)
         self.args = args
 
         # Message request and execution metas
@@ -45,12 +110,16 @@ class Message(object):
         # Message network requestid meta for transport
         self.requestid = None
 
+        # Deferred for the pending response, set by the transport
+        self.defer = None
+
 
     def __repr__(self):
         tdict = {
             'message': 'm',
             'command': 'c',
             'event':   'e',
+            'batch':   'b',
         }
         alist = []
         if DEBUG:
@@ -60,7 +129,7 @@ class Message(object):
                                       str_object(self.result, max_elements=MAX_ELEMENTS)))
         if DEBUG and self.requestid:
             alist.append('#%s' %(self.requestid))
-        if DEBUG and hasattr(self, 'defer'):
+        if DEBUG and self.defer is not None:
             alist.append('d=%s' %(str(self.defer),))
         if self.args is not None:
             alist += list(self.args)
@@ -81,18 +150,6 @@ class Message(object):
         return self.type == msgtype
 
 
-    #----- REQUEST ID NUMBERS ------
-
-    # Sequence number stored as class attribute
-    __sequence = 0
-
-    def get_requestid(self):
-        ''' Set a new unique request id in current object and return it '''
-        Message.__sequence += 1
-        requestid = self.requestid = Message.__sequence
-        return requestid
-
-
     #----- EXECUTION ------
 
     def set_success(self, result):
@@ -149,9 +206,10 @@ class Message(object):
 
     def load_dict(self, other):
         ''' Load the instance data from a dict '''
-        self.name = other.get('name')
-        if self.name is None:
+        name = other.get('name')
+        if name is None:
             raise ValueError("Missing message name")
+        self.name = compat_intern(name)
         self.args = other.get('args', tuple())
         self.requestid = other.get('requestid')
         self.response = other.get('response')
@@ -203,7 +261,7 @@ class Message(object):
             args = shlex.split(string)
             if not len(args):
                 return self
-            self.name = args[0]
+            self.name = compat_intern(args[0])
             self.args = args[1:]
             return self
 
@@ -215,35 +273,14 @@ class Message(object):
         if opts:
             args = opts.split(',')
 
-        self.name = match.group(1)
+        self.name = compat_intern(match.group(1))
         self.args = tuple(args)
 
         # If '$' agruments is encountered, replace with positional argument
         # from parse_event
         if parse_event and opts:
-            args = []
-            for arg in self.args:
-                if arg == '$*':
-                    args += parse_event.args
-                elif arg == '$n':
-                    args.append(parse_event.name)
-                elif arg.startswith('$'):
-                    index = arg[1:]
-                    opt = arg
-                    try:
-                        opt = parse_event.args[int(index)-1]
-                    except IndexError:
-                        raise IndexError(
-                            "%s argument index error '$%s', but message has %s args" %(
-                                self.name, index, len(parse_event.args)))
-                    except ValueError:
-                        raise ValueError(
-                            "%s argument value error '$%s'" %(
-                                self.name, index))
-                    args.append(opt)
-                else:
-                    args.append(arg)
-            self.args = tuple(args)
+            self.args = expand_args(self.name, compile_args(self.args),
+                                    parse_event.name, parse_event.args)
 
         return self
 
@@ -254,10 +291,10 @@ class Message(object):
     def create(msgtype, *args, **kw):
         ''' Create a new Message() object '''
 
-        for cls in Message.__subclasses__():
-            if cls.type == msgtype:
-                return cls(*args, **kw)
-        raise ValueError("Uknown message type '%s'" %(msgtype))
+        cls = MESSAGE_TYPES.get(msgtype)
+        if cls is None:
+            raise ValueError("Uknown message type '%s'" %(msgtype))
+        return cls(*args, **kw)
 
 
     @staticmethod
@@ -265,11 +302,20 @@ class Message(object):
         ''' Create a new Message() object from a json string '''
 
         jdict = json.loads(other, encoding='ascii')
-        msgtype = jdict.get('type')
+        if not isinstance(jdict, dict):
+            raise ValueError("Message json is not a dict")
+        return Message.create_from_dict(jdict)
+
+
+    @staticmethod
+    def create_from_dict(other):
+        ''' Create a new Message() object from a dict '''
+
+        msgtype = other.get('type')
         if msgtype is None:
-            raise ValueError("Missing message type in json")
+            raise ValueError("Missing message type")
 
-        return Message.create(msgtype).load_dict(jdict)
+        return Message.create(msgtype).load_dict(other)
 
 
 
@@ -277,9 +323,63 @@ class MsgEvent(Message):
     ''' Event message '''
     type = 'event'
     want_response = False
+    __slots__ = ()
 
 
 class MsgCommand(Message):
     ''' Command message '''
     type = 'command'
     want_response = True
+    __slots__ = ()
+
+
+
+class MsgBatch(Message):
+    ''' Batch of messages. The messages are carried in args '''
+    type = 'batch'
+    want_response = False
+    __slots__ = ()
+
+    def load_dict(self, other):
+        ''' Load the instance data from a dict, including the messages '''
+        Message.load_dict(self, other)
+        self.args = tuple(Message.create_from_dict(m) for m in self.args)
+        return self
+
+
+
+
+class MessageTemplate(object):
+    ''' A precompiled message string, using the syntax of Message.load_str().
+        The '$' arguments are resolved when the template is expanded.
+    '''
+    __slots__ = ('name', 'slots', 'args')
+
+    def __init__(self, string):
+        message = Message().load_str(string)
+        self.name = message.name
+        self.slots = compile_args(message.args)
+
+        # Templates without '$' arguments don't need expansion
+        self.args = None
+        if all(argtype == ARG_LITERAL for (argtype, value) in self.slots):
+            self.args = message.args
+
+    def expand(self, parse_name, parse_args):
+        ''' Return the args of the template using the given name and args
+            for the '$' arguments
+        '''
+        if self.args is not None:
+            return self.args
+        return expand_args(self.name, self.slots, parse_name, parse_args)
+
+    def create(self, msgtype, parse_event):
+        ''' Create a new Message() object from the template, using
+            parse_event for the '$' arguments
+        '''
+        return Message.create(msgtype, self.name,
+                              *self.expand(parse_event.name, parse_event.args))
+
+
+# Lookup table for Message.create()
+MESSAGE_TYPES = {cls.type: cls for cls in Message.__subclasses__()}
@@ -3,11 +3,6 @@
 from __future__ import absolute_import, division, print_function
 
 import os
-try:
-    from queue import Queue, Empty
-except ImportError:
-    # Py2
-    from Queue import Queue, Empty
 from binascii import hexlify
 
 from twisted.internet.defer import Deferred
@@ -16,8 +11,11 @@ from twisted.internet.protocol import ReconnectingClientFactory
 
 from lumina.plugin import Plugin
 from lumina.message import Message
-from lumina.exceptions import (UnknownCommandException, UnknownMessageException)
+from lumina.exceptions import (UnknownCommandException, UnknownMessageException,
+                               QueueFullException)
 from lumina.protocol import LuminaProtocol
+from lumina.log import logLevelCommand, logHistoryCommand
+from lumina.cmdqueue import CommandQueue, OVERFLOW_DROP_OLDEST
 
 
 
@@ -53,6 +51,8 @@ class NodeFactory(ReconnectingClientFactory):
     def buildProtocol(self, addr):
         self.resetDelay()
         protocol = NodeProtocol(parent=self.parent, sequence=self.sequence)
+        protocol.batch = self.parent.node_batch
+        protocol.batch_window = self.parent.node_batch_window
         self.sequence += 1
         return protocol
 
@@ -76,6 +76,15 @@ class Node(Plugin):
     GLOBAL_CONFIG = {
         'port'  : dict(default=5326, help='Lumina port to connect to', type=int),
         'server': dict(default='localhost', help='Lumina server to connect to'),
+        'batch' : dict(default=False, help='Batch messages sent on the node link', type=bool),
+        'batch_window': dict(default=0.0, help='Time in seconds to collect messages '
+                             'for a batch, 0 for current reactor tick', type=float),
+        'queue_size': dict(default=1000, help='Max number of messages to queue '
+                           'while not connected to the server', type=int),
+        'status_window': dict(default=0.0, help='Time in seconds to collect status '
+                              'changes before sending, 0 for current reactor tick', type=float),
+        'status_interval': dict(default=1.0, help='Min time in seconds between '
+                                'status messages to the server', type=float),
     }
 
     # Override the list of configure methods from the Plugin
@@ -87,6 +96,9 @@ class Node(Plugin):
 
         self.node_commands = {
             '_info': lambda a: self.master.get_info(),
+            '_queues': lambda a: self.get_queues(),
+            '_loglevel': lambda a: logLevelCommand(*a.args),
+            '_log': lambda a: logHistoryCommand(*a.args),
         }
 
         self.commands.update(self.node_commands)
@@ -97,11 +109,28 @@ class Node(Plugin):
 
         self.serverhost = self.master.config.get('server')
         self.serverport = self.master.config.get('port')
+        self.node_batch = self.master.config.get('batch')
+        self.node_batch_window = self.master.config.get('batch_window')
         self.nodeid = hexlify(os.urandom(3))
 
         self.node_protocol = None
         self.node_active = False
-        self.node_queue = Queue()
+        self.node_queue = CommandQueue(self.master.reactor,
+                                       maxsize=self.master.config.get('queue_size'),
+                                       overflow=OVERFLOW_DROP_OLDEST,
+                                       dropped=self.queue_dropped)
+
+        # Command queues of this node, reported by get_queues()
+        self.queues = {
+            'node': self.node_queue,
+        }
+
+        # -- Subscribe to the change of state by sending status to the
+        #    server. Bursts of changes are sent as the final state.
+        self.status_callback = self.status.add_callback(
+            self.sendStatus, reactor=self.master.reactor,
+            window=self.master.config.get('status_window'),
+            interval=self.master.config.get('status_interval'))
 
         # -- Connect to the server
         self.node_factory = NodeFactory(parent=self)
@@ -156,14 +185,8 @@ class Node(Plugin):
         # -- Enable sending of events from the parent class
         self.node_active = True
 
-        # -- Subscribe to the change of state by sending status back to server
-        #    Send the update now
-        def send_status(status):
-            ''' Status update callback. Only send updates if connected '''
-            if self.node_active:
-                self.send(Message.create('command', 'status', status.state,
-                                         status.old, status.why))
-        self.status.add_callback(send_status, run_now=True)
+        # -- Send the current status now
+        self.status_callback.fire(self.status)
 
         # -- Flush any queue that might have been accumulated before
         #    connecting to the controller
@@ -223,33 +246,42 @@ class Node(Plugin):
 
         self.log.info("{e}  --  Not connected to server, "
                       "queueing. {n} items in queue",
-                      e=message, n=self.node_queue.qsize())
+                      e=message, n=len(self.node_queue))
 
         return defer
 
 
+    def queue_dropped(self, item):
+        ''' Fail a message dropped from the full queue '''
+        (defer, sendfn, message) = item  # pylint: disable=unused-variable
+        self.log.warn("{e}  --  Queue full, dropping", e=message)
+        defer.errback(QueueFullException())
+
+
     def sendQueue(self):
         ''' (Attempt to) send the accumulated queue to the protocol. '''
 
-        qsize = self.node_queue.qsize()
+        qsize = len(self.node_queue)
         if not self.node_active or not qsize:
             return
 
         self.log.info("Flushing queue of {n} items...", n=qsize)
 
-        try:
-            while True:
-                (defer, sendfn, message) = self.node_queue.get(False)
-                self.log.info("Sending {e}", e=message)
-                result = sendfn(message)
-                if isinstance(result, Deferred):
-                    # Ensure that when the result object fires that the
-                    # defer object also fire
-                    result.chainDeferred(defer)
-                else:
-                    defer.callback(result)
-        except Empty:
-            pass
+        while self.node_active and len(self.node_queue):
+            (defer, sendfn, message) = self.node_queue.get()
+            self.log.info("Sending {e}", e=message)
+            result = sendfn(message)
+            if isinstance(result, Deferred):
+                # Ensure that when the result object fires that the
+                # defer object also fire
+                result.chainDeferred(defer)
+            else:
+                defer.callback(result)
+
+
+    def get_queues(self):
+        ''' Return the metrics of the command queues of this node '''
+        return {name: queue.stats() for (name, queue) in self.queues.items()}
 
 
     # -- Helper functions
@@ -258,3 +290,12 @@ class Node(Plugin):
         # The events must be prefixed by its node name before being
         # dispatched to the server
         return self.send(Message.create('event', self.name + '/' + name, *args))
+
+
+    def sendStatus(self, status):
+        ''' Send status to server. Only send updates if connected, as the
+            status is sent when connecting.
+        '''
+        if self.node_active:
+            self.send(Message.create('command', 'status', status.state,
+                                     status.old, status.why))
@@ -2,19 +2,16 @@
 """ Sony VPL-HW50 projector interface plugin """
 from __future__ import absolute_import, division, print_function
 
-try:
-    from queue import Queue
-except ImportError:
-    # Py2
-    from Queue import Queue
-
-from twisted.internet.defer import Deferred
+from twisted.internet.defer import Deferred, succeed
 from twisted.internet.protocol import Protocol
 from twisted.internet.serialport import EIGHTBITS, PARITY_EVEN, STOPBITS_ONE
 from twisted.internet.task import LoopingCall
 
 from lumina.node import Node
-from lumina.exceptions import LuminaException, TimeoutException, CommandRunException
+from lumina.state import StateCache
+from lumina.cmdqueue import CommandQueue, PRIO_NORMAL, PRIO_LOW, OVERFLOW_DROP_OLDEST
+from lumina.exceptions import (LuminaException, TimeoutException, CommandRunException,
+                               QueueFullException)
 from lumina.serial import ReconnectingSerialPort
 
 
@@ -39,6 +36,7 @@ class FrameException(LuminaException):
 FRAMESIZE = 8
 SOF = 0xA9
 EOF = 0x9A
+SOF_BYTE = bytes(bytearray([SOF]))
 
 # REQUEST/RESPONSE TYPES
 SET_RQ = 0x00
@@ -192,6 +190,12 @@ STATUS_POWER_SAVINGSTANDBY = 0x0008
 STATUS_ERROR2_OK = 0x0000
 STATUS_ERROR2_HIGHLAND = 0x0020
 
+# IR commands setting a status item, and the resulting item value
+IR_STATUS = {
+    IR_PWRON: (STATUS_POWER, STATUS_POWER_POWERON),
+    IR_PWROFF: (STATUS_POWER, STATUS_POWER_STANDBY),
+}
+
 
 
 #def ison(result):
@@ -228,26 +232,41 @@ def dumptext(data):
     return s1 + ' ' + s2
 
 
-def decode_hw50frame(frame):
-    ''' Decode an input frame '''
-    b = bytearray(frame)
+class Dump(object):
+    ''' Printout of data for logging. The text is only rendered if the log
+        event is formatted, i.e. not filtered out.
+    '''
+    __slots__ = ('data', 'text')
+
+    def __init__(self, data, text=False):
+        self.data = data
+        self.text = text
+
+    def __str__(self):
+        if self.text:
+            return dump(self.data) + ' - ' + dumptext(self.data)
+        return dump(self.data)
+
 
-    if len(frame) != FRAMESIZE:
+
+def decode_hw50frame(frame, offset=0):
+    ''' Decode an input frame located at offset in frame '''
+    b = frame if isinstance(frame, bytearray) else bytearray(frame)
+    o = offset
+
+    if len(b) - o < FRAMESIZE:
         raise FrameException("Incomplete frame")
-    if b[0] != SOF:
+    if b[o] != SOF:
         raise FrameException("Wrong SOF field")
-    if b[7] != EOF:
+    if b[o+7] != EOF:
         raise FrameException("Wrong EOF field")
 
-    c = 0
-    for x in range(1, 6):
-        c |= b[x]
-    if b[6] != c:
+    if b[o+6] != b[o+1] | b[o+2] | b[o+3] | b[o+4] | b[o+5]:
         raise FrameException("Checksum failure")
 
-    item = b[1]<<8 | b[2]
-    cmd = b[3]
-    data = b[4]<<8 | b[5]
+    item = b[o+1]<<8 | b[o+2]
+    cmd = b[o+3]
+    data = b[o+4]<<8 | b[o+5]
 
     if cmd == ACK_RS:
         if item not in RESPONSES:
@@ -281,25 +300,99 @@ def encode_hw50frame(item, cmd, data):
 
 
 
+class FrameScanner(object):
+    ''' Incremental scanner for HW50 frames in the received byte stream.
+        Any junk between the frames is discarded. Data that might be the
+        start of a frame is kept until the next call to feed().
+    '''
+
+    def __init__(self, log):
+        self.log = log
+        self.buf = bytearray()
+
+
+    def feed(self, data):
+        ''' Add data to the scanner and return the list of decoded
+            (item, cmd, data) frames.
+        '''
+        buf = self.buf
+        buf += data
+        frames = []
+        last = len(buf) - FRAMESIZE
+        start = 0
+        x = 0
+        while x <= last:
+
+            # Search for SOF and EOF markers
+            x = buf.find(SOF_BYTE, x)
+            if x < 0:
+                # No frame start in the rest of the data
+                x = len(buf)
+                break
+            if x > last:
+                break
+            if buf[x+FRAMESIZE-1] != EOF:
+                x += 1
+                continue
+
+            try:
+                frame = decode_hw50frame(buf, x)
+            except FrameException as e:
+                # Frame decode fails, continue scanning from next position
+                self.log.info("Decode failure: {e}", e=e)
+                x += 1
+                continue
+
+            if x > start:
+                self.log.info("Discarded junk in data, '{b}'",
+                              b=Dump(bytes(buf[start:x])))
+            self.log.debug("     >>>  {f}", f=Dump(bytes(buf[x:x+FRAMESIZE]), text=True))
+
+            x += FRAMESIZE
+            start = x
+            frames.append(frame)
+
+        # Keep the data from the resync point, which is never more than
+        # a frame
+        if x > start:
+            self.log.info("Discarded junk in data, '{b}'",
+                          b=Dump(bytes(buf[start:x])))
+        del buf[:x]
+        return frames
+
+
+
 class HW50Protocol(Protocol):
     ''' Sony VPL-HW50 protocol interface '''
     timeout = 3
     keepalive_interval = 60
+    cache_lifetime = 120
+    queue_size = 32
 
     def __init__(self, parent):
         self.parent = parent
         self.master = parent.master
         self.log = parent.log
         self.status = parent.status
-        self.rxbuffer = bytearray()
-        self.queue = Queue()
+        self.scanner = FrameScanner(self.log)
+        self.queue = CommandQueue(self.master.reactor, maxsize=self.queue_size,
+                                  overflow=OVERFLOW_DROP_OLDEST, dropped=self.dropped)
+        parent.queues['device'] = self.queue
         self.lastmsg = None
+        self.cache = StateCache(self.master.reactor, lifetime=self.cache_lifetime)
+
+        # Number of SET and IR commands queued or written per status item.
+        # A GET reply only records the value if the item has not been
+        # changed since the GET was queued, as the reply might be older
+        # than the change.
+        self.changes = {}
 
 
     def connectionMade(self):
         self.log.info("Connected to HW50")
         self.status.set_YELLOW('Connected, waiting for data')
         self.lastmsg = None
+        self.cache.invalidate()
 
         # Setup a regular keepalive heartbeat (this operation will also
         # set the state green when the response is given)
@@ -310,6 +403,7 @@ class HW50Protocol(Protocol):
     def connectionLost(self, reason):  # pylint: disable=W0222
         self.log.info("Lost connection with HW50: {e}", e=reason.getErrorMessage())
         self.status.set_RED("Lost connection")
+        self.cache.invalidate()
         if self.timer:
             self.timer.cancel()
             self.timer = None
@@ -319,70 +413,61 @@ class HW50Protocol(Protocol):
 
     def dataReceived(self, data):
         self.log.debug('{_rawin}', rawin=data)
-        msg = bytearray(data)
-        self.rxbuffer += msg
-
-        # Search for data frames in the incoming data buffer. Search for SOF and EOF markers.
-        # It will only iterate if the buffer is large enough for a complete frame
-        buf = self.rxbuffer
-        for x in range(0, len(buf)-FRAMESIZE+1):
-
-            # Search for SOF and EOF markers
-            if buf[x] == SOF and buf[x+FRAMESIZE-1] == EOF:
-
-                try:
-                    # Decode the response-frame
-                    frame = buf[x:x+FRAMESIZE]
-                    self.log.debug("     >>>  {f} - {t}", f=dump(frame), t=dumptext(frame))
-                    (item, cmd, data) = decode_hw50frame(frame)
-
-                except FrameException as e:
 
-                    # Frame decode fails, do iteration
-                    self.log.info("Decode failure: {e}", e=e)
-                    continue
-
-                # Consume all data up until the frame (including pre-junk) and
-                # save the data after the frame for later processing
-                self.rxbuffer = buf[x+FRAMESIZE:]
-                if x > 0 or len(self.rxbuffer) > 0:
-                    self.log.info("Discarded junk in data, '{b}' before, '{a}' after",
-                                  b=dump(buf[:x]), a=dump(self.rxbuffer))
-
-                # From here on, consider this a valid frame
-                self.status.set_GREEN()
-
-                # Process the reply frame
-                if self.lastmsg:
-
-                    # Clean up
-                    self.lastmsg = None
-                    self.timer.cancel()
-                    self.timer = None
-
-                    # Treat either A) Unknown frame type commands or
-                    #              B) ACK_RS types with non-ACK_OK responses
-                    # as errors
-                    if cmd not in TYPES or (cmd == ACK_RS and item != ACK_OK):
-                        self.defer.errback(CommandRunException(RESPONSES.get(item, item)))
-                    else:
-                        self.defer.callback(data)
+        for (item, cmd, data) in self.scanner.feed(data):
+
+            # From here on, consider this a valid frame
+            self.status.set_GREEN()
+
+            # Process the reply frame
+            if self.lastmsg:
+
+                # Clean up
+                (rqitem, rqcmd, rqdata, rqchanges) = self.lastrequest
+                self.lastmsg = None
+                self.timer.cancel()
+                self.timer = None
+
+                # Treat either A) Unknown frame type commands or
+                #              B) ACK_RS types with non-ACK_OK responses
+                # as errors
+                if cmd not in TYPES or (cmd == ACK_RS and item != ACK_OK):
+                    self.cache.invalidate(rqitem)
+                    self.defer.errback(CommandRunException(RESPONSES.get(item, item)))
+                else:
+                    # Record the confirmed value
+                    if rqcmd == SET_RQ:
+                        self.cache.set(rqitem, rqdata)
+                    elif rqcmd == GET_RQ and rqchanges == self.changes.get(rqitem, 0):
+                        self.cache.set(rqitem, data)
+                    self.defer.callback(data)
+
+                # Proceed to the next command
+                self.send_next()
+                continue
 
-                    # Proceed to the next command
-                    self.send_next()
-                    return
+            # Not interested in the received message, but it might be a
+            # change of device state
+            self.cache.invalidate(item)
+            self.log.info("-IGNORED-")
 
-                # Not interested in the received message
-                self.log.info("-IGNORED-")
 
+    def command(self, item, cmd=GET_RQ, data=0x0, priority=PRIO_NORMAL):
 
-    def command(self, item, cmd=GET_RQ, data=0x0):
+        # Don't set items that are known to have the value already. The
+        # value is unknown until the command has completed.
+        if cmd == SET_RQ:
+            (key, value) = IR_STATUS.get(item, (item, data))
+            if self.cache.is_set(key, value):
+                self.log.debug("Item {i:04x} is already {d:04x}, skipping", i=key, d=value)
+                return succeed(None)
+            self.change(key)
 
         # Compile next request
         msg = encode_hw50frame(item, cmd, data)
 
         defer = Deferred()
-        self.queue.put((defer, msg, item))
+        self.queue.put((defer, msg, item, cmd, data, self.changes.get(item, 0)), priority)
         self.send_next()
         return defer
 
@@ -392,13 +477,17 @@ class HW50Protocol(Protocol):
         if self.lastmsg:
             return
 
-        while self.queue.qsize():
-            (defer, msg, item) = self.queue.get(False)
+        while len(self.queue):
+            (defer, msg, item, cmd, data, changes) = self.queue.get()
 
             # Send the command
-            self.log.debug("     <<<  {m} - {t}", m=dump(msg), t=dumptext(msg))
+            self.log.debug("     <<<  {m}", m=Dump(msg, text=True))
             self.transport.write(str(msg))
 
+            # Replies to GETs sent before this change are stale from now on
+            if cmd == SET_RQ:
+                self.change(IR_STATUS.get(item, (item, data))[0])
+
             # Prepare for reply where applicable
             ircmd = item & IRCMD_MASK
 
@@ -410,15 +499,23 @@ class HW50Protocol(Protocol):
 
             # Expect reply, setup timer and return
             self.lastmsg = msg
+            self.lastrequest = (item, cmd, data, changes)
             self.defer = defer
             self.timer = self.master.reactor.callLater(self.timeout, self.timedout)
             return
 
 
+    def change(self, key):
+        ''' Forget the value of key, which is being changed '''
+        self.cache.invalidate(key)
+        self.changes[key] = self.changes.get(key, 0) + 1
+
+
     def timedout(self):
         # The timeout response is to fail the request and proceed with the next command
-        self.log.info("Command {c} timed out", c=dumptext(self.lastmsg))
+        self.log.info("Command {c} timed out", c=Dump(self.lastmsg, text=True))
         self.status.set_RED('Timeout')
+        self.cache.invalidate()
         self.timer = None
         self.lastmsg = None
         self.defer.errback(TimeoutException())
@@ -426,10 +523,16 @@ class HW50Protocol(Protocol):
 
 
     def keepalive(self):
-        defer = self.command(STATUS_POWER)
+        defer = self.command(STATUS_POWER, priority=PRIO_LOW)
         defer.addBoth(lambda a: None)
 
 
+    def dropped(self, item):
+        ''' Fail a command dropped from the full queue '''
+        self.log.info("Queue full, dropping command")
+        item[0].errback(QueueFullException())
+
+
 
 class Hw50SerialPort(ReconnectingSerialPort):
     noisy = False
@@ -4,21 +4,59 @@ from __future__ import absolute_import, division, print_function
 
 import array
 
-from ola.OlaClient import OlaClient  # pylint: disable=E0401
+from zope.interface import implementer
+from twisted.internet.interfaces import IReadDescriptor
+from twisted.internet.task import LoopingCall
+from ola.OlaClient import OlaClient, OLADNotRunningException  # pylint: disable=E0401
 
 from lumina.node import Node
+from lumina.exceptions import ConfigException
+
+
+
+@implementer(IReadDescriptor)
+class OlaReader(object):
+    ''' Reactor reader for the replies on the OLA client socket '''
+
+    def __init__(self, client):
+        self.client = client
+
+    def fileno(self):
+        return self.client.GetSocket().fileno()
+
+    def doRead(self):
+        self.client.SocketReady()
+
+    def connectionLost(self, reason):
+        pass
+
+    def logPrefix(self):
+        return 'ola'
 
 
 
 class Led(Node):
-    ''' LED dimmer control interface '''
+    ''' LED dimmer control interface. The DMX frames are sent from a universe
+        buffer over a persistent connection to olad. Fades are rendered at a
+        fixed frame rate, and only changed frames are sent.
+    '''
 
     universe = 0
 
     CONFIG = {
         'universe': dict(default=0, help='DMX universe to use', type=int),
+        'channels': dict(default=4, help='Number of DMX channels to use', type=int),
+        'fps'     : dict(default=40, help='DMX frame rate during fades', type=int),
+        'gamma'   : dict(default=1.0, help='Gamma correction of the output, 1.0 for linear', type=float),
     }
 
+    # --- Initialization
+    def __init__(self):
+        self.dmx = None
+        self.reader = None
+        self.loop = None
+
+
     # --- Interfaces
     def configure(self):
 
@@ -26,7 +64,8 @@ class Led(Node):
         )
 
         self.commands = {
-            'set'       : lambda a: self.command(*a.args),
+            'set'       : lambda a: self.fade(0, *a.args),
+            'fade'      : lambda a: self.fade(*a.args),
         }
 
 
@@ -34,18 +73,126 @@ class Led(Node):
     def setup(self):
 
         self.universe = self.master.config.get('universe', name=self.name)
+        self.channels = self.master.config.get('channels', name=self.name)
+        self.fps = self.master.config.get('fps', name=self.name)
+        gamma = self.master.config.get('gamma', name=self.name)
+
+        if self.fps <= 0:
+            raise ConfigException("%s.fps: Frame rate must be positive, got %s" %(
+                self.name, self.fps))
+        if gamma <= 0:
+            raise ConfigException("%s.gamma: Gamma must be positive, got %s" %(
+                self.name, gamma))
+
+        # The channel levels before gamma correction, and the fades in
+        # progress as channel: (start level, target level, start time, duration)
+        self.levels = [0.0] * self.channels
+        self.fades = {}
+
+        # Output value for each level
+        self.curve = array.array('B', [int(255 * (i / 255) ** gamma + 0.5)
+                                       for i in range(256)])
+
+        # The last sent frame
+        self.sent = None
+
+        self.loop = LoopingCall(self.render)
+        self.loop.clock = self.master.reactor
+
+        self.connect()
+
+
+    def close(self):
+        Node.close(self)
+        if self.loop and self.loop.running:
+            self.loop.stop()
+        if self.dmx:
+            self.master.reactor.removeReader(self.reader)
+            self.dmx.GetSocket().close()
+            self.dmx = None
+
+
+    # --- Connection
+    def connect(self):
+        ''' Connect to olad. Returns False if it failed. '''
+        try:
+            self.dmx = OlaClient(close_callback=self.olaConnectionLost)
+        except OLADNotRunningException as e:
+            self.log.error("Connection to olad failed: {e}", e=str(e))
+            self.status.set_RED('Connection failed')
+            return False
+
+        self.reader = OlaReader(self.dmx)
+        self.master.reactor.addReader(self.reader)
         self.status.set_GREEN()
+        self.sent = None
+        return True
+
+
+    def olaConnectionLost(self):
+        ''' Handle the loss of the olad connection '''
+        self.log.info("Lost connection with olad")
+        self.status.set_RED('Lost connection')
+        self.master.reactor.removeReader(self.reader)
+        self.dmx = None
 
 
     # --- Commands
-    def command(self, *args):
-        self.dmx = OlaClient()
-        data = array.array('B')
-        data.append(int(args[0]))
-        data.append(int(args[1]))
-        data.append(int(args[2]))
-        data.append(int(args[3]))
-        self.dmx.SendDmx(self.universe, data, None)
+    def fade(self, duration, *levels):
+        ''' Fade the channels to the given levels over duration seconds '''
+        duration = float(duration)
+        now = self.master.reactor.seconds()
+
+        for (ch, level) in enumerate(levels[:self.channels]):
+            level = min(max(float(level), 0.0), 255.0)
+            if duration > 0:
+                self.fades[ch] = (self.levels[ch], level, now, duration)
+            else:
+                self.fades.pop(ch, None)
+                self.levels[ch] = level
+
+        self.render()
+        if self.fades and not self.loop.running:
+            self.loop.start(1.0 / self.fps, now=False)
+
+
+    # --- Output
+    def render(self):
+        ''' Update the levels of the fades in progress and send the frame if
+            it has changed
+        '''
+        now = self.master.reactor.seconds()
+        levels = self.levels
+
+        done = []
+        for (ch, (start, target, t0, duration)) in self.fades.items():
+            progress = (now - t0) / duration
+            if progress >= 1.0:
+                levels[ch] = target
+                done.append(ch)
+            else:
+                levels[ch] = start + (target - start) * progress
+        for ch in done:
+            del self.fades[ch]
+
+        curve = self.curve
+        frame = array.array('B', [curve[int(level + 0.5)] for level in levels])
+        if frame != self.sent:
+            self.send_frame(frame)
+
+        if not self.fades and self.loop.running:
+            self.loop.stop()
+
+
+    def send_frame(self, frame):
+        ''' Send the DMX frame to olad '''
+        if self.dmx is None and not self.connect():
+            return
+        if not self.dmx.SendDmx(self.universe, frame, None):
+            self.log.info("Failed to send DMX frame")
+            self.sent = None
+            return
+        self.sent = frame
 
 
 
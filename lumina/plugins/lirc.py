@@ -2,14 +2,16 @@
 """ Linux IR controller interface plugin """
 from __future__ import absolute_import, division, print_function
 
-#from twisted.internet.protocol import Protocol
+from collections import deque
+
 from twisted.protocols.basic import LineReceiver
-from twisted.internet.endpoints import UNIXClientEndpoint
+from twisted.internet.protocol import ClientFactory
 from twisted.internet.defer import Deferred
 
 from lumina.plugin import Plugin
-from lumina.utils import connectProtocol
-from lumina.exceptions import CommandRunException #, TimeoutException
+from lumina.cmdqueue import CommandQueue, PRIO_NORMAL, OVERFLOW_DROP_OLDEST
+from lumina.exceptions import (CommandRunException, TimeoutException, NoConnectionException,
+                               QueueFullException, CommandParseException, ConfigException)
 
 # Protocol response:
 #   BEGIN
@@ -25,63 +27,145 @@ from lumina.exceptions import CommandRunException #, TimeoutException
 #   1
 #   unknown command: "KEY_PURE_DIRECTs"
 #   END
+#
+# lircd might also send blocks which are not replies, e.g.
+#   BEGIN
+#   SIGHUP
+#   END
 
 
-class LircProtocol(LineReceiver):
-    delimiter = '\n'
+class LircRequest(object):
+    ''' A request to lircd '''
+
+    def __init__(self, command):
+        self.command = command
+        self.defer = Deferred()
+        self.timer = None
+
+
+    def callback(self, result):
+        if self.timer is not None and self.timer.active():
+            self.timer.cancel()
+        self.defer.callback(result)
+
+
+    def errback(self, exc):
+        if self.timer is not None and self.timer.active():
+            self.timer.cancel()
+        self.defer.errback(exc)
+
 
-    CONFIG = {
-        'port': dict(default='/var/run/lirc/lircd', help='LIRC communication port'),
-    }
 
-    # FIXME: Add proper timeout handling
+class LircFactory(ClientFactory):
+    noisy = False
 
-    def __init__(self, parent, command, port):
-        self.master = parent.master
+    def __init__(self, parent):
+        self.parent = parent
+
+    def buildProtocol(self, addr):
+        return LircProtocol(self.parent)
+
+    def clientConnectionFailed(self, connector, reason):
+        self.parent.clientConnectionFailed(reason)
+
+
+
+class LircProtocol(LineReceiver):
+    ''' Connection to lircd. Parses the BEGIN/END reply blocks and passes
+        them to the parent.
+    '''
+    delimiter = '\n'
+
+    def __init__(self, parent):
+        self.parent = parent
         self.log = parent.log
-        self.status = parent.status
-        self.command = command
-        self.port = port
-        self.defer = Deferred()
+        self.reset()
+
 
-        endpoint = UNIXClientEndpoint(self.master.reactor, self.port)
-        connectProtocol(endpoint, self)
+    def reset(self):
+        self.state = None
+        self.command = None
+        self.success = None
+        self.data = []
+        self.lines = 0
 
 
     def connectionMade(self):
-        self.status.set_YELLOW('Connecting')
-        self.log.debug('{_dataout}', dataout=self.command)
-        self.transport.write(self.command)
+        self.parent.clientConnectionMade(self)
 
 
-    #def connectionLost(self, reason):
-    #    self.log.info("Conneciton lost: {c}", c=reason)
-    #    self.status.set_OFF()
+    def connectionLost(self, reason):  # pylint: disable=W0222
+        self.parent.clientConnectionLost(self, reason)
 
 
     def lineReceived(self, data):
         self.log.debug('{_datain}', datain=data)
-        if data == 'BEGIN':
-            pass
-        elif data == 'SUCCESS':
-            self.status.set_GREEN()
-            self.defer.callback(None)
-        elif data == 'ERROR':
-            self.status.set_RED()
-            # FIXME: Extract the error message
-            self.defer.errback(CommandRunException())
-        elif data == 'END':
-            self.transport.loseConnection()
+        state = self.state
+
+        if state is None:
+            # Ignore anything outside the blocks
+            if data == 'BEGIN':
+                self.state = 'command'
+
+        elif state == 'command':
+            self.command = data
+            self.state = 'result'
+
+        elif state == 'result':
+            if data == 'SUCCESS':
+                self.success = True
+            elif data == 'ERROR':
+                self.success = False
+            elif data == 'DATA':
+                self.state = 'count'
+            elif data == 'END':
+                self.blockReceived()
+
+        elif state == 'count':
+            try:
+                self.lines = int(data)
+            except ValueError:
+                self.log.info("Protocol error, invalid DATA length '{d}'", d=data)
+                self.reset()
+                return
+            self.state = 'data' if self.lines else 'end'
+
+        elif state == 'data':
+            self.data.append(data)
+            self.lines -= 1
+            if not self.lines:
+                self.state = 'end'
+
+        elif state == 'end':
+            if data == 'END':
+                self.blockReceived()
+            else:
+                self.log.info("Protocol error, expected END, got '{d}'", d=data)
+                self.reset()
+
+
+    def blockReceived(self):
+        (command, success, data) = (self.command, self.success, self.data)
+        self.reset()
+        self.parent.replyReceived(command, success, data)
 
 
 
 class Lirc(Plugin):
-    ''' IR control interface '''
+    ''' IR control interface. The commands are sent over a persistent
+        connection to lircd, which is connected when there are commands to
+        send. lircd replies in order, so the commands are sent without
+        waiting for the previous replies.
+    '''
 
     CONFIG = {
         'port': dict(default='/var/run/lirc/lircd', help='LIRC communication port'),
+        'max_hold': dict(default=10.0, help='Max duration in seconds to hold a key', type=float),
     }
 
+    timeout = 5
+    queue_size = 32
+
 
     # --- Interfaces
     def configure(self):
@@ -97,19 +181,185 @@ class Lirc(Plugin):
     def setup(self):
 
         self.port = self.master.config.get('port', name=self.name)
+        self.max_hold = self.master.config.get('max_hold', name=self.name)
+        if self.max_hold <= 0:
+            raise ConfigException("%s.max_hold: Hold duration must be positive, got %s" %(
+                self.name, self.max_hold))
         self.status.set_OFF()
 
+        self.queue = CommandQueue(self.master.reactor, maxsize=self.queue_size,
+                                  overflow=OVERFLOW_DROP_OLDEST, dropped=self.dropped)
+        self.factory = LircFactory(self)
+        self.running = True
+        self.client = None
+        self.connecting = False
+        self.inflight = deque()
+
+        # The (name, key) of the keys which might be held by lircd
+        self.held = []
+
+
+    def close(self):
+        Plugin.close(self)
+        self.running = False
+        if self.client:
+            # Release the held keys. Best effort, as the replies are not
+            # awaited.
+            for (name, key) in self.held:
+                self.client.transport.write('SEND_STOP %s %s\n' %(name, key))
+            self.client.transport.loseConnection()
+
+
+    # --- Connection
+    def clientConnectionMade(self, client):
+        self.log.info("Connected to lircd")
+        self.client = client
+        self.connecting = False
+        self.send_next()
+
+
+    def clientConnectionLost(self, client, reason):
+        # A connection dropped by timedout() has already been cleaned up
+        if client is not self.client:
+            return
+        self.log.info("Lost connection with lircd: {e}", e=reason.getErrorMessage())
+        self.client = None
+
+        # The requests in progress will not be replied
+        self.fail_inflight(NoConnectionException(reason.getErrorMessage()))
+
+        # Reconnect if there are more requests
+        self.send_next()
+
+
+    def clientConnectionFailed(self, reason):
+        self.log.info("Connection to lircd failed: {e}", e=reason.getErrorMessage())
+        self.status.set_RED('Connection failed')
+        self.connecting = False
+        for request in self.queue.clear():
+            request.errback(NoConnectionException(reason.getErrorMessage()))
+
+
+    # --- Commands
+    def command(self, op, name, key, priority=PRIO_NORMAL):
+        ''' Send the lircd command op, e.g. SEND_ONCE, for key on the remote
+            name.
+        '''
+        request = LircRequest('%s %s %s' %(op, name, key))
+        self.queue.put(request, priority)
+        self.send_next()
+        return request.defer
+
+
+    def hold(self, name, key, duration):
+        ''' Hold the key on remote name for duration seconds, limited to
+            max_hold. The returned Deferred fires when the key has been
+            released.
+        '''
+        if not duration > 0:
+            raise CommandParseException("Hold duration must be positive, got %s" %(duration,))
+        if duration > self.max_hold:
+            self.log.info("Limiting hold of {k} from {d}s to {m}s",
+                          k=key, d=duration, m=self.max_hold)
+            duration = self.max_hold
+
+        defer = Deferred()
+        held = (name, key)
+        self.held.append(held)
+
+        def started(result):
+            self.master.reactor.callLater(duration, stop)
+
+        def stop():
+            release().chainDeferred(defer)
+
+        def failed(failure):
+            # lircd might have started repeating the key even if the reply
+            # failed, so release it anyway, but report the original failure
+            release().addBoth(lambda result: failure).chainDeferred(defer)
+
+        def release():
+            d = self.command('SEND_STOP', name, key)
+            d.addBoth(released)
+            return d
+
+        def released(result):
+            self.held.remove(held)
+            return result
+
+        self.command('SEND_START', name, key).addCallbacks(started, failed)
+        return defer
+
+
+    def send_next(self):
+        if not self.running or not len(self.queue):
+            return
 
-    def command(self, op, name, key):
-        command = '%s %s %s\n' %(op, name, key)
-
-        lp = LircProtocol(self, command, self.port)
-        return lp.defer
+        # Connect if needed. Next will be clientConnectionMade() or
+        # clientConnectionFailed()
+        if self.client is None:
+            if not self.connecting:
+                self.connecting = True
+                self.master.reactor.connectUNIX(self.port, self.factory)
+            return
+
+        while len(self.queue):
+            request = self.queue.get()
+
+            self.log.debug('{_dataout}', dataout=request.command)
+            self.client.transport.write(request.command + '\n')
 
-        #d = Deferred()
-        #connectEndpoint(LircProtocol(self, command, d),
-        #                UNIXClientEndpoint, self.port)
-        #return d
+            # Expect reply
+            request.timer = self.master.reactor.callLater(self.timeout, self.timedout, request)
+            self.inflight.append(request)
+
+
+    def replyReceived(self, command, success, data):
+        if not self.inflight or self.inflight[0].command != command:
+            self.log.debug("Ignoring '{c}'", c=command)
+            return
+        request = self.inflight.popleft()
+
+        if success:
+            self.status.set_GREEN()
+            request.callback(data)
+        else:
+            self.status.set_RED()
+            err = ' '.join(data) or 'Command failed'
+            self.log.info("Command '{c}' failed: {e}", c=command, e=err)
+            request.errback(CommandRunException(err))
+
+
+    def timedout(self, request):
+        # The timeout response is to fail the request. Drop the connection
+        # to get in sync with lircd again, which will fail any other
+        # requests in progress.
+        self.log.info("Command '{c}' timed out", c=request.command)
+        self.status.set_RED('Timeout')
+        self.inflight.remove(request)
+
+        # Detach from the connection before failing the requests, so any
+        # new commands from their errbacks are sent on a new connection
+        client = self.client
+        self.client = None
+        if client:
+            client.transport.loseConnection()
+        request.errback(TimeoutException())
+        self.fail_inflight(NoConnectionException('Timeout'))
+        self.send_next()
+
+
+    def fail_inflight(self, exc):
+        ''' Fail the requests sent and not yet replied '''
+        (inflight, self.inflight) = (self.inflight, deque())
+        for request in inflight:
+            request.errback(exc)
+
+
+    def dropped(self, request):
+        ''' Fail a command dropped from the full queue '''
+        self.log.info("Queue full, dropping command")
+        request.errback(QueueFullException())
 
 
 
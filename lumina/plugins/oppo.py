@@ -2,22 +2,30 @@
 """ Oppo BDP-103 Media Player interface plugin """
 from __future__ import absolute_import, division, print_function
 
-try:
-    from queue import Queue
-except ImportError:
-    # Py2
-    from Queue import Queue
-
-from twisted.internet.defer import Deferred
+from twisted.internet.defer import Deferred, succeed
 from twisted.protocols.basic import LineReceiver
 from twisted.internet.serialport import EIGHTBITS, PARITY_NONE, STOPBITS_ONE
 from twisted.internet.task import LoopingCall
 
 from lumina.node import Node
-from lumina.exceptions import CommandRunException, TimeoutException
+from lumina.state import StateCache
+from lumina.cmdqueue import CommandQueue, PRIO_NORMAL, PRIO_LOW, OVERFLOW_DROP_OLDEST
+from lumina.exceptions import CommandRunException, TimeoutException, QueueFullException
 from lumina.serial import ReconnectingSerialPort
 
 
+# Commands setting a state, given as the query command and its reply
+STATE_COMMANDS = {
+    'PON': ('QPW', 'ON'),
+    'POF': ('QPW', 'OFF'),
+}
+
+# Status updates and the query command whose state they change
+STATUS_UPDATES = {
+    'UPW': 'QPW',
+}
+
+
 #def ison(result):
 #    if result[0]=='ON':
 #        return True
@@ -29,20 +37,26 @@ class OppoProtocol(LineReceiver):
     delimiter = '\x0d'
     timeout = 10
     keepalive_interval = 60
+    cache_lifetime = 120
+    queue_size = 32
 
     def __init__(self, parent):
         self.parent = parent
         self.master = parent.master
         self.log = parent.log
         self.status = parent.status
-        self.queue = Queue()
+        self.queue = CommandQueue(self.master.reactor, maxsize=self.queue_size,
+                                  overflow=OVERFLOW_DROP_OLDEST, dropped=self.dropped)
+        parent.queues['device'] = self.queue
         self.lastcommand = None
+        self.cache = StateCache(self.master.reactor, lifetime=self.cache_lifetime)
 
 
     def connectionMade(self):
         self.log.info("Connected to Oppo")
         self.status.set_YELLOW('Connected, waiting for data')
         self.lastcommand = None
+        self.cache.invalidate()
 
         # Setup a regular keepalive heartbeat (this operation will also
         # set the state green when the response is given)
@@ -53,6 +67,7 @@ class OppoProtocol(LineReceiver):
     def connectionLost(self, reason):  # pylint: disable=W0222
         self.log.info("Lost connection with Oppo: {e}", e=reason.getErrorMessage())
         self.status.set_RED("Lost connection")
+        self.cache.invalidate()
         if self.timer:
             self.timer.cancel()
             self.timer = None
@@ -116,6 +131,15 @@ class OppoProtocol(LineReceiver):
             self.timer.cancel()
             self.timer = None
 
+            # Record the confirmed state
+            query = cmd
+            if cmd in STATE_COMMANDS:
+                query = STATE_COMMANDS[cmd][0]
+            if result == 'OK' and query[0] == 'Q' and args:
+                self.cache.set(query, args[0])
+            else:
+                self.cache.invalidate(query)
+
             # Send reply back to caller
             if result == 'OK':
                 self.defer.callback(args)
@@ -126,6 +150,10 @@ class OppoProtocol(LineReceiver):
             self.send_next()
             return
 
+        # Status updates change the state of the device
+        if cmd in STATUS_UPDATES:
+            self.cache.invalidate(STATUS_UPDATES[cmd])
+
         # Status update message we're interested in?
         #for (ev, d) in self.parent.events.items():
 
@@ -148,7 +176,16 @@ class OppoProtocol(LineReceiver):
         self.log.info("-IGNORED-")
 
 
-    def command(self, command, *args):
+    def command(self, command, *args, **kw):
+
+        # Don't set states the device is known to have. The state is unknown
+        # until the command has completed.
+        if command in STATE_COMMANDS:
+            (query, value) = STATE_COMMANDS[command]
+            if self.cache.is_set(query, value):
+                self.log.debug("State '{q}' is already {v}, skipping", q=query, v=value)
+                return succeed([value])
+            self.cache.invalidate(query)
 
         # Compile next request
         a = ' '.join(args)
@@ -157,7 +194,7 @@ class OppoProtocol(LineReceiver):
         msg = '#%s%s' %(command, a)
 
         defer = Deferred()
-        self.queue.put((defer, msg, command))
+        self.queue.put((defer, msg, command), kw.get('priority', PRIO_NORMAL))
         self.send_next()
         return defer
 
@@ -167,8 +204,8 @@ class OppoProtocol(LineReceiver):
         if self.lastcommand:
             return
 
-        while self.queue.qsize():
-            (defer, msg, command) = self.queue.get(False)
+        while len(self.queue):
+            (defer, msg, command) = self.queue.get()
 
             # Send the command
             self.log.debug("RAW  <<<  ({l})'{d}'", l=len(msg), d=msg)
@@ -186,6 +223,7 @@ class OppoProtocol(LineReceiver):
         # The timeout response is to fail the request and proceed with the next command
         self.log.info("Command '{c}' timed out", c=self.lastcommand)
         self.status.set_RED('Timeout')
+        self.cache.invalidate()
         self.timer = None
         self.lastcommand = None
         self.defer.errback(TimeoutException())
@@ -193,10 +231,16 @@ class OppoProtocol(LineReceiver):
 
 
     def keepalive(self):
-        defer = self.command('QPW')
+        defer = self.command('QPW', priority=PRIO_LOW)
         defer.addBoth(lambda a: None)
 
 
+    def dropped(self, item):
+        ''' Fail a command dropped from the full queue '''
+        self.log.info("Queue full, dropping command")
+        item[0].errback(QueueFullException())
+
+
 
 class OppoSerialPort(ReconnectingSerialPort):
     noisy = False
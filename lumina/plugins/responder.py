@@ -4,7 +4,7 @@ from __future__ import absolute_import, division, print_function
 
 from twisted.internet.defer import Deferred, maybeDeferred
 
-from lumina.message import Message
+from lumina.message import Message, MessageTemplate
 from lumina.plugin import Plugin
 from lumina.exceptions import CommandParseException, ConfigException, CommandRunException
 
@@ -39,6 +39,19 @@ class Responder(Plugin):
             self.groups[n] = v
             self.actions[k] = n
 
+        # Compile the actions and the group elements into templates
+        self.action_templates = {
+            k: self.compile_template(v, k) for k, v in self.actions.items()
+        }
+        self.group_templates = {
+            k: tuple(self.compile_template(c, k) for c in v) for k, v in self.groups.items()
+        }
+
+        # Cache of flattened groups. It is valid as long as the server's
+        # command table is unchanged.
+        self.plans = {}
+        self.plans_version = None
+
         self.server = server = self.master.get_plugin_by_module('server')
         if not server:
             raise ConfigException('No server plugin found. Missing server in config?')
@@ -58,13 +71,13 @@ class Responder(Plugin):
         ''' Respond to the received event '''
 
         # Find the action for the given event
-        action = self.actions.get(message.name, None)
-        if action is None:
+        template = self.action_templates.get(message.name, None)
+        if template is None:
             self.log.info("Ignoring event '{e}'", e=message)
             return None
 
         # Make a command and parse its args and run it
-        command = Message.create('command').load_str(action, parse_event=message)
+        command = template.create('command', message)
         self.log.info("Event '{e}' -> '{c}'", e=message, c=command)
         return self.run_command(command)
 
@@ -74,39 +87,85 @@ class Responder(Plugin):
         return self.run_commandlist(command, self.get_commandlist(command))
 
 
-    def get_commandlist(self, command, depth=0):
-        ''' Get a list of (fn,message) tuples for the given command (Message() object
-            expected '''
+    def compile_template(self, string, name):
+        ''' Return a MessageTemplate() from the configured string '''
+        try:
+            return MessageTemplate(string)
+        except Exception as e:
+            raise ConfigException("%s: Invalid command '%s' in '%s': %s" %(
+                self.name, string, name, e))
 
-        # Get the function for the given command. Return None if no command exists
-        fn = self.server.commands.get(command.name)
+
+    def is_group(self, name):
+        ''' Return True if the named command is a group '''
 
         # If the function is this run_command() function, it indicates that the function
         # is an group that needs to be expanded. Else this is a function that should be
         # called normally.
-        if fn != self.run_command:
-            return [command]
+        return self.server.commands.get(name) == self.run_command
 
-        # ...the returned object is a composite and needs to be flattened/expanded
+
+    def compile_group(self, name, depth=0):
+        ''' Return the flattened plan for the named group. The plan is a tuple
+            of template chains, one chain per resulting command. The first
+            template of the chain is expanded with the group command, and
+            each subsequent template is expanded with the result of the
+            previous.
+        '''
 
         # Make sure this function isn't run too many times in case of loops in
         # the groups
         if depth >= self.max_depth:
             raise CommandParseException('Too many command group levels (%s). Loop?' %(depth,))
 
-        # Get the groups list for the command and flatten it
+        plan = []
+        for template in self.group_templates[name]:
+
+            # Iterate over the group elements to check if they too are groups
+            if self.is_group(template.name):
+                plan += [(template,) + chain
+                         for chain in self.compile_group(template.name, depth=depth+1)]
+            else:
+                plan.append((template,))
+
+        return tuple(plan)
+
+
+    def get_plan(self, name):
+        ''' Return the cached plan for the named group '''
+
+        # Changes to the command table might change what is a group
+        if self.plans_version != self.server.commands_version:
+            self.plans = {}
+            self.plans_version = self.server.commands_version
+
+        plan = self.plans.get(name)
+        if plan is None:
+            plan = self.plans[name] = self.compile_group(name)
+        return plan
+
+
+    def get_commandlist(self, command):
+        ''' Get a list of commands for the given command (Message() object
+            expected '''
+
+        # Non-group commands are run as-is
+        if not self.is_group(command.name):
+            return [command]
+
+        # ...the command is a composite and needs to be expanded
         commandlist = []
-        for cmd in self.groups[command.name]:
+        for chain in self.get_plan(command.name):
 
-            # Convert the string group-element to Event() object
+            # Expand the args through the chain of nested groups
+            (name, args) = (command.name, command.args)
             try:
-                message = Message.create('command').load_str(cmd, parse_event=command)
+                for template in chain:
+                    (name, args) = (template.name, template.expand(name, args))
             except Exception as e:
                 raise CommandParseException("Command parsing failed: %s" %(e))
-            #ev.system = command.system   # To override log system
 
-            # Iterate over the found commands to check if they too are groups
-            commandlist += self.get_commandlist(message, depth=depth+1)
+            commandlist.append(Message.create('command', name, *args))
 
         return commandlist
 
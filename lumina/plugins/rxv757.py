@@ -3,6 +3,7 @@
 from __future__ import absolute_import, division, print_function
 
 from lumina.node import Node
+from lumina.exceptions import CommandParseException
 
 
 
@@ -25,6 +26,10 @@ class Rxv757(Node):
             'off' :        lambda a: self.c('Yamaha_RXV757', 'KEY_POWER_OFF'),
             'pure_direct': lambda a: self.c('Yamaha_RXV757', 'KEY_PURE_DIRECT'),
             'mute' :       lambda a: self.c('Yamaha_RXV757', 'KEY_MUTE'),
+
+            # Held keys, optionally with the duration in seconds
+            'volume/up' :   lambda a: self.h('Yamaha_RXV757', 'KEY_VOLUMEUP', *a.args),
+            'volume/down' : lambda a: self.h('Yamaha_RXV757', 'KEY_VOLUMEDOWN', *a.args),
         }
 
 
@@ -39,5 +44,13 @@ class Rxv757(Node):
         return self.lirc.command('SEND_ONCE', name, key)
 
 
+    def h(self, name, key, duration=0.5):
+        try:
+            duration = float(duration)
+        except (TypeError, ValueError):
+            raise CommandParseException("Invalid hold duration '%s'" %(duration,))
+        return self.lirc.hold(name, key, duration)
+
+
 
 PLUGIN = Rxv757
@@ -9,11 +9,13 @@ from twisted.internet.task import LoopingCall
 
 from lumina.plugin import Plugin
 from lumina.exceptions import (NodeConfigException, UnknownCommandException,
-                               UnknownMessageException, NodeRegistrationException)
-from lumina.log import Logger
+                               UnknownMessageException, NodeRegistrationException,
+                               ConfigException)
+from lumina.log import Logger, logLevelCommand, logHistoryCommand
 from lumina.protocol import LuminaProtocol
-from lumina.state import ColorState
+from lumina.state import ColorState, ColorStateAggregate
 from lumina.compat import compat_itervalues
+from lumina.utils import Snapshot
 
 
 # FIXME: Add this as a config statement
@@ -45,11 +47,15 @@ class ServerProtocol(LuminaProtocol):
         self.events = []
         self.commands = []
 
-        # Remote node status
+        # Remote node status. Changes within the same reactor tick are
+        # collapsed.
+        reactor = parent.master.reactor
         self.status = ColorState(log=self.log)
-        self.status.add_callback(self.parent.update_status, run_now=True)
+        self.status.add_callback(self.parent.update_status, run_now=True,
+                                 reactor=reactor, window=0)
 
-        self.link.add_callback(self.parent.update_status, run_now=True)
+        self.link.add_callback(self.parent.update_status, run_now=True,
+                               reactor=reactor, window=0)
 
 
     def connectionMade(self):
@@ -101,6 +107,8 @@ class ServerFactory(Factory):
 
     def buildProtocol(self, addr):
         protocol = ServerProtocol(parent=self.parent, sequence=self.sequence)
+        protocol.batch = self.parent.batch
+        protocol.batch_window = self.parent.batch_window
         self.sequence += 1
         return protocol
 
@@ -120,9 +128,14 @@ class Server(Plugin):
 
     GLOBAL_CONFIG = {
         'port': dict(default=5326, help='Lumina server port', type=int),
+        'batch' : dict(default=False, help='Batch messages sent on the node link', type=bool),
+        'batch_window': dict(default=0.0, help='Time in seconds to collect messages '
+                             'for a batch, 0 for current reactor tick', type=float),
     }
     CONFIG = {
         'nodes': dict(default=[], help='List of nodes', type=list),
+        'activity_interval': dict(default=60.0, help='Max age in seconds of the node '
+                                  'activity times in the server info', type=float),
     }
 
 
@@ -132,6 +145,8 @@ class Server(Plugin):
             '_info': lambda a: self.master.get_info(),
             '_name': lambda a: self.master.hostname,
             '_server': lambda a: self.get_info(),
+            '_loglevel': lambda a: logLevelCommand(*a.args),
+            '_log': lambda a: logHistoryCommand(*a.args),
         }
 
 
@@ -139,18 +154,41 @@ class Server(Plugin):
 
         # -- Config options
         self.port = self.master.config.get('port')
+        self.batch = self.master.config.get('batch')
+        self.batch_window = self.master.config.get('batch_window')
         self.nodelist = self.master.config.get('nodes', name=self.name)
-
-        # -- List of server commands and events
-        self.events = []
+        self.activity_interval = self.master.config.get('activity_interval', name=self.name)
+        if self.activity_interval <= 0:
+            raise ConfigException("%s.activity_interval: Interval must be positive, got %s" %(
+                self.name, self.activity_interval))
+
+        # -- Cached info. The version is incremented on changes of the nodes,
+        #    their status and the events.
+        self.info_version = 0
+        self.info = Snapshot(self.build_info, self.get_info_version)
+
+        # -- Registry of server commands and events, and the node owning
+        #    them (None for the server's own). The version is incremented on
+        #    every change of the commands.
+        self.events = set()
+        self.event_owner = {}
         self.commands = {}
+        self.command_owner = {}
+        self.commands_version = 0
         self.add_commands(self.server_commands)
 
+        # -- Listeners notified about node changes and events,
+        #    called as fn(topic, data)
+        self.listeners = []
+
         # -- List of connections
         self.connections = []
         self.node_sequence = 0
 
         self.node_status = ColorState(log=self.log, state='OFF')
+        self.node_states = ColorStateAggregate()
+        self.status.add_callback(self.info_changed)
+        self.node_status.add_callback(self.info_changed)
 
         # -- Create list of expected unconnected nodes
         #    Do not use dict comprehension here, as the dict must be updated
@@ -160,7 +198,9 @@ class Server(Plugin):
         for n in self.nodelist:
             self.nodes[n] = ServerProtocol(self)
         for n in self.nodes:
-            self.nodes[n].name = n
+            node = self.nodes[n]
+            node.name = node.status.name = node.link.name = n
+            self.add_node_status(node)
 
         # -- Setup default do-nothing handler for the incoming events
         self.handle_event = lambda a: self.log.info("Ignoring event '{a}'", a=a)
@@ -185,17 +225,20 @@ class Server(Plugin):
     def connectionLost(self, node, reason):
         ''' Remove the disconnected node client '''
         self.connections.remove(node)
+        self.info_version += 1
         if not self.connections:
             self.status.set_YELLOW('No nodes connected')
 
         if node.events:
-            self.remove_events(node.events)
+            self.remove_events(node.events, owner=node)
             node.events = []
 
         if node.commands:
-            self.remove_commands(node.commands)
+            self.remove_commands(node.commands, owner=node)
             node.commands = []
 
+        self.notify_node(node)
+
 
     def messageReceived(self, node, message):
         ''' Handle message from nodes '''
@@ -237,19 +280,14 @@ class Server(Plugin):
         # -- Event type
         elif message.is_type('event'):
 
-            prefix = node.name + '/'
-
-            # -- Check that the event is valid and registred
-            if not cmd.startswith(prefix):
-                node.log.error("Ignoring undeclared event '{m}'", m=message)
-                return None
-
-            cmd = cmd.replace(prefix, '')
-            if cmd not in self.events:
+            # -- Check that the event is registered by this node
+            if self.event_owner.get(cmd) is not node:
                 node.log.error("Ignoring undeclared event '{m}'", m=message)
                 return None
 
             # -- A new incoming event.
+            if self.listeners:
+                self.notify('event/' + cmd, message.args)
             return self.handle_event(message)
 
 
@@ -297,12 +335,16 @@ class Server(Plugin):
                         other.hostname, other.hostid))
 
         # -- Register the new node
+        self.info_version += 1
+        if name in self.nodes:
+            self.remove_node_status(self.nodes[name])
         self.nodes[name] = node
+        self.add_node_status(node)
 
         # -- Register node events
         evlist = [name + '/' + e for e in params.get('events', [])]
         node.events = tuple(evlist)
-        self.add_events(evlist)
+        self.add_events(evlist, owner=node)
 
         # -- Register node commands
         evlist = [name + '/' + e for e in params.get('commands', [])]
@@ -312,18 +354,62 @@ class Server(Plugin):
         # server's command dict. Each node command will get an entry which
         # will use LuminaProtocol.send(). This function will simply
         # send the request to the node and return a deferred for the reply
-        self.add_commands({e: node.send for e in evlist})
+        self.add_commands({e: node.send for e in evlist}, owner=node)
+
+        self.notify_node(node)
 
         # Return success
         return None
 
 
-    def update_status(self, status):  # pylint: disable=W0613
+    def update_status(self, status):
         ''' Status update callback '''
-        l = [node.status for node in compat_itervalues(self.nodes)]
-        l += [node.link for node in compat_itervalues(self.nodes)]
-        (state, why) = ColorState.combine(*l)
-        self.node_status.set(state, why)
+        self.info_version += 1
+        if self.node_states.update(status):
+            self.node_status.set(*self.node_states.combine())
+        node = self.nodes.get(status.name)
+        if node is not None and status in (node.status, node.link):
+            self.notify_node(node)
+
+
+    def add_node_status(self, node):
+        ''' Include the status of node in the node status '''
+        self.info_version += 1
+        self.node_states.add(node.status)
+        self.node_states.add(node.link)
+        self.node_status.set(*self.node_states.combine())
+
+
+    def remove_node_status(self, node):
+        ''' Remove the status of node from the node status '''
+        self.info_version += 1
+        self.node_states.remove(node.status)
+        self.node_states.remove(node.link)
+        self.node_status.set(*self.node_states.combine())
+
+
+    def add_listener(self, listener):
+        ''' Add a listener for node changes and events '''
+        self.listeners.append(listener)
+
+
+    def remove_listener(self, listener):
+        ''' Remove a listener added by add_listener() '''
+        self.listeners.remove(listener)
+
+
+    def notify(self, topic, data):
+        ''' Notify the listeners. The topic is 'node/<name>' for changes of a
+            node, and 'event/<name>' for events.
+        '''
+        for listener in list(self.listeners):
+            listener(topic, data)
+
+
+    def notify_node(self, node):
+        ''' Notify the listeners about changes of a registered node '''
+        if self.listeners and self.nodes.get(node.name) is node:
+            self.notify('node/' + node.name, self.node_info(node))
 
 
     def run_command(self, message, fail_on_unknown=True):
@@ -339,7 +425,7 @@ class Server(Plugin):
         return self.commands.get(message.name, unknown_command)(message)
 
 
-    def add_commands(self, commands):
+    def add_commands(self, commands, owner=None):
         ''' Add to the dict of known commands and register their callback fns '''
         self.log.info("Registering {n} commands", n=len(commands))
         for name, fn in commands.items():
@@ -347,53 +433,72 @@ class Server(Plugin):
             if name in self.commands:
                 raise NodeConfigException("Duplicate command '{n}'".format(n=name))
             self.commands[name] = fn
+            self.command_owner[name] = owner
+        self.commands_version += 1
 
 
-    def remove_commands(self, commands):
-        ''' Remove from the dict of known commands '''
+    def remove_commands(self, commands, owner=None):
+        ''' Remove the commands of owner from the dict of known commands '''
         self.log.info("Removing {n} commands", n=len(commands))
         for name in commands:
+            if name not in self.commands or self.command_owner[name] is not owner:
+                continue
             self.log.debug("  - {n}", n=name)
             del self.commands[name]
+            del self.command_owner[name]
+        self.commands_version += 1
 
 
-    def add_events(self, events):
-        ''' Add to the list of known events'''
+    def add_events(self, events, owner=None):
+        ''' Add to the set of known events'''
         self.log.info("Registering {n} events", n=len(events))
         for name in events:
             self.log.debug("  + {n}", n=name)
             if name in self.events:
                 raise NodeConfigException("Duplicate event '{n}'".format(n=name))
-            self.events.append(name)
+            self.events.add(name)
+            self.event_owner[name] = owner
+        self.info_version += 1
 
 
-    def remove_events(self, events):
-        ''' Remove from the list of known events'''
+    def remove_events(self, events, owner=None):
+        ''' Remove the events of owner from the set of known events'''
         self.log.info("Removing {n} events", n=len(events))
         for name in events:
+            if name not in self.events or self.event_owner[name] is not owner:
+                continue
             self.log.debug("  - {n}", n=name)
             self.events.remove(name)
+            del self.event_owner[name]
+        self.info_version += 1
+
+
+    def info_changed(self, status):  # pylint: disable=W0613
+        ''' Status callback invalidating the info '''
+        self.info_version += 1
+
+
+    def get_info_version(self):
+        ''' Return the version of the info. The node activity times change
+            on every message, so they are not tracked. Instead the info is
+            refreshed every activity_interval.
+        '''
+        return (self.info_version, self.commands_version,
+                int(self.master.reactor.seconds() // self.activity_interval))
 
 
     def get_info(self):
-        ''' Return a dict of info about this server '''
+        ''' Return a dict of info about this server. The dict is cached and
+            must not be modified.
+        '''
+        return self.info.get()
+
+
+    def build_info(self):
+        ''' Build the dict of info about this server '''
         return {
-            'nodes'       : [{
-                'name'         : node.name,
-                'nodeid'       : node.nodeid,
-                'hostname'     : node.hostname,
-                'hostid'       : node.hostid,
-                'module'       : node.module,
-                'sequence'     : node.sequence,
-                'status'       : node.status.state,
-                'status_why'   : node.status.why,
-                'link'         : node.link.state,
-                'link_why'     : node.link.why,
-                'commands'     : node.commands,
-                'events'       : node.events,
-                'connected'    : node.connected,
-                'lastactivity' : node.lastactivity.isoformat()+'Z',
-            } for node in compat_itervalues(self.nodes)],
+            'nodes'       : [self.node_info(node)
+                             for node in compat_itervalues(self.nodes)],
             'n_commands'  : len(self.commands),
             'n_events'    : len(self.events),
             'status'      : str(self.status),
@@ -403,5 +508,26 @@ class Server(Plugin):
         }
 
 
+    @staticmethod
+    def node_info(node):
+        ''' Return a dict of info about the node '''
+        return {
+            'name'         : node.name,
+            'nodeid'       : node.nodeid,
+            'hostname'     : node.hostname,
+            'hostid'       : node.hostid,
+            'module'       : node.module,
+            'sequence'     : node.sequence,
+            'status'       : node.status.state,
+            'status_why'   : node.status.why,
+            'link'         : node.link.state,
+            'link_why'     : node.link.why,
+            'commands'     : node.commands,
+            'events'       : node.events,
+            'connected'    : node.connected,
+            'lastactivity' : node.lastactivity.isoformat()+'Z',
+        }
+
+
 
 PLUGIN = Server
@@ -9,8 +9,9 @@ from twisted.internet.task import LoopingCall
 from lumina.node import Node
 from lumina.state import ColorState
 from lumina.log import Logger
+from lumina.timingwheel import TimingWheel
 from lumina.exceptions import NoConnectionException, TimeoutException, ConfigException
-from lumina.utils import add_defer_timeout, cmp_dict
+from lumina.compat import compat_str
 
 
 
@@ -24,75 +25,187 @@ from lumina.utils import add_defer_timeout, cmp_dict
 
 
 
-def getnextelement(data):
-    ''' Return the (next,remain) raw data element from data.
+# Attributes for matching incoming raw events against the configured events,
+# given by the protocol of the configured event. An attribute missing in
+# both the raw event and the configured event counts as a match.
+EVENT_MATCH = {
+    'arctech': ('house', 'group', 'unit', 'method'),
+    'sartano': ('code', ),
+    'temp': ('id', ),
+}
 
-        The syntax is:  NN:string  where NN is a number indicating length of string
-                        iNs        where N is am integer number
-    '''
-    if data and data[0] in '0123456789':
-        n = data.split(':', 1)
-        l = int(n[0])
-        return (n[1][:l], n[1][l:])
-    elif data and data[0] == 'i':
-        n = data.split('s', 1)
-        l = int(n[0][1:])
-        return (l, n[1])
-    else:
-        return (None, data)
 
 
+def event_key(d, attrs):
+    ''' Return the lookup key of dict d for the event index '''
+    return tuple(d.get(a) for a in attrs)
 
-def parsestream(data):
-    ''' Parse self.data byte stream into list of elements in self.elements '''
-    el = []
 
-    # Split the raw data into list of objects (string or integer)
-    while True:
-        (element, data) = getnextelement(data)
-        if element is None:
-            return el, data
-        el.append(element)
 
+# Expected commands and their number of arguments
+COMMAND_SIZE = {
+    'TDSensorEvent': 6,
+    'TDRawDeviceEvent': 2,
+    'TDControllerEvent': 4,
+    'TDDeviceEvent': 3,
+}
 
+# Resolution of the double trigger protection time
+PROTECT_RESOLUTION = 0.25
 
-def parseelements(elements, log):
-    ''' Parse elements into events '''
-    events = []
+# Accepted values of boolean event options. Strings are accepted for
+# compatibility with older configurations.
+BOOLEANS = {
+    True: True, 'True': True, 'true': True, '1': True,
+    False: False, 'False': False, 'false': False, '0': False,
+}
 
-    # Extract events from list of objects
-    while elements:
-        cmd = elements.pop(0)
-        #log("%s  %s" %(cmd,elements))
+# Don't compact the parser buffer before this many bytes have been consumed
+COMPACT_SIZE = 4096
+
+ORD_0 = ord('0')
+ORD_9 = ord('9')
+ORD_I = ord('i')
+
+
+
+class TelldusParser(object):
+    ''' Incremental parser for the Telldus byte stream. Data is added with
+        feed() and the complete events are returned from the events()
+        generator. Incomplete elements and events are kept until more data
+        arrives. The element syntax is:
+
+            NN:string  where NN is a number indicating length of string
+            iNs        where N is an integer number
+
+        An event is a command name element followed by the number of
+        arguments given in COMMAND_SIZE. String elements are returned as
+        native str.
+    '''
+
+    def __init__(self, log=None):
+        self.log = log
+        self.buf = bytearray()
+        self.offset = 0
+        self.event = []
+        self.size = None
+
+
+    def reset(self):
+        ''' Drop all the buffered data '''
+        del self.buf[:]
+        self.offset = 0
+        self.event = []
+        self.size = None
+
+
+    def feed(self, data):
+        ''' Add data to the parser '''
+
+        # The consumed data is only discarded when it dominates the buffer,
+        # which keeps the cost of moving the remaining data amortized linear
+        offset = self.offset
+        if offset and (offset == len(self.buf) or
+                       (offset > COMPACT_SIZE and offset*2 > len(self.buf))):
+            del self.buf[:offset]
+            self.offset = 0
+        self.buf += data
+
+
+    def next_element(self):
+        ''' Return the next element from the buffer, or None if there is no
+            complete element available. Raises ValueError on invalid syntax.
+        '''
+        buf = self.buf
+        offset = self.offset
+        if offset >= len(buf):
+            return None
+
+        first = buf[offset]
+        if first == ORD_I:
+            end = buf.find(b's', offset+1)
+            if end < 0:
+                return None
+            element = int(bytes(buf[offset+1:end]))
+            self.offset = end + 1
+            return element
+
+        elif ORD_0 <= first <= ORD_9:
+            sep = buf.find(b':', offset+1)
+            if sep < 0:
+                return None
+            end = sep + 1 + int(bytes(buf[offset:sep]))
+            if end > len(buf):
+                return None
+            element = compat_str(bytes(buf[sep+1:end]))
+            self.offset = end
+            return element
+
+        raise ValueError("Invalid element '%s'" %(bytes(buf[offset:offset+16]),))
+
+
+    def events(self):
+        ''' Generator returning the complete events in the buffer '''
+        while True:
+            try:
+                element = self.next_element()
+            except ValueError as e:
+                if self.log:
+                    self.log.info("{e}, dropping data", e=e)
+                self.reset()
+                return
+            if element is None:
+                return
+
+            if self.size is None:
+                size = COMMAND_SIZE.get(element)
+                if size is None:
+                    # There is no way to resync to the next event
+                    if self.log:
+                        self.log.info("Unknown command '{c}', dropping data", c=element)
+                    self.reset()
+                    return
+                self.size = size
+                self.event = [element]
+                continue
+
+            self.event.append(element)
+            if len(self.event) > self.size:
+                (event, self.event, self.size) = (self.event, [], None)
+                yield event
 
-        # Expected commands and their parameter length
-        cmdsize = {
-            'TDSensorEvent': 6,
-            'TDRawDeviceEvent': 2,
-            'TDControllerEvent': 4,
-            'TDDeviceEvent': 3,
-        }
 
-        if cmd not in cmdsize:
-            log.info("Unknown command '{c}', dropping {e}", c=cmd, e=elements)
-            elements = []
-            break
 
-        l = cmdsize[cmd]
+def parsestream(data):
+    ''' Parse data into list of elements. Returns the elements and the
+        remaining data which could not be parsed.
+    '''
+    parser = TelldusParser()
+    parser.feed(data)
+    el = []
+    while True:
+        try:
+            element = parser.next_element()
+        except ValueError:
+            element = None
+        if element is None:
+            return el, bytes(parser.buf[parser.offset:])
+        el.append(element)
 
-        if l > len(elements):
-            # Does not got enough data for command. Stop and postpone processing
-            log.info("Missing elements for command '{c}', "
-                     "got {e}, needs {l} args.", c=cmd, e=elements, l=l)
-            elements = []
-            break
 
-        l = cmdsize[cmd]
-        args = elements[:l]
-        elements = elements[l:]
-        events.append([cmd] + args)
 
-    return (events, elements)
+def args_within(a, b, delta):
+    ''' Return True if the event args a and b are equal, except for numeric
+        values which may differ by at most delta
+    '''
+    if isinstance(a, (tuple, list)) and isinstance(b, (tuple, list)):
+        return len(a) == len(b) and all(args_within(x, y, delta) for (x, y) in zip(a, b))
+    if a == b:
+        return True
+    try:
+        return abs(float(a) - float(b)) <= delta
+    except (TypeError, ValueError):
+        return False
 
 
 
@@ -177,8 +290,7 @@ class TelldusIn(Protocol):
         self.log.info("Connected to {p}", p=self.path)
         self.connected = True
         self.status.set_YELLOW('IN connection made, waiting for data')
-        self.data = ''
-        self.elements = []
+        self.parser = TelldusParser(log=self.log)
         self.timer = LoopingCall(self.dataTimeout)
         self.timer.start(self.idleTimeout, now=False)
 
@@ -204,21 +316,14 @@ class TelldusIn(Protocol):
         else:
             self.timer.start(self.idleTimeout, now=False)
 
-        data = self.data + data
-
-        # Interpret the data
-        (elements, data) = parsestream(data)
-        (events, elements) = parseelements(elements, log=self.log)
-
-        # Save remaining data for next call (incomplete frame received)
-        self.data = data
-        self.elements = elements
+        # Incomplete data is kept by the parser until the next call
+        self.parser.feed(data)
 
         # At this point, we can consider the connection up
         self.status.set_GREEN()
 
         # Iterate over the received events
-        for event in events:
+        for event in self.parser.events():
             self.log.debug('{_datain}', datain=event)
             self.parent.parse_event(event)
 
@@ -233,135 +338,220 @@ class TelldusIn(Protocol):
 class TelldusOutFactory(ClientFactory):
     noisy = False
 
-    def __init__(self, protocol, parent):
-        self.protocol = protocol
+    def __init__(self, client, parent):
+        self.client = client
         self.parent = parent
-        self.log = protocol.log
 
     def buildProtocol(self, addr):
-        return self.protocol
+        return self.client
 
     def clientConnectionFailed(self, connector, reason):
-        self.protocol.clientConnectionFailed(reason)
+        self.parent.clientConnectionFailed(self.client, reason)
+
+
+
+class TelldusRequest(object):
+    ''' A pending Telldus command. Coalesced commands share the request, and
+        all their deferreds are fired with the result of the request.
+    '''
+
+    def __init__(self, cmd, key):
+        self.cmd = cmd
+        self.data = generate(cmd)
+        self.key = key
+        self.defers = []
+        self.timer = None
+
+
+    def callback(self, result):
+        if self.timer is not None and self.timer.active():
+            self.timer.cancel()
+        for defer in self.defers:
+            defer.callback(result)
+
+
+    def errback(self, exc):
+        if self.timer is not None and self.timer.active():
+            self.timer.cancel()
+        for defer in self.defers:
+            defer.errback(exc)
 
 
 
 #
 # The Telldus client protocol requires opening the a UNIX socket to the client address,
-# write the command and close the connection when done.
+# write the command and close the connection when done. telldusd serves only one
+# command per connection, so the connections cannot be reused.
 #
-class TelldusOut(Protocol):
-    ''' Class for outgoing Telldus commands '''
+class TelldusClient(Protocol):
+    ''' A connection to the Telldus client socket for running one request '''
 
     noisy = False
-    path = '/tmp/TelldusClient'
-    timeout = 5
-
 
-    # This object is connected when data is about to be sent and closed right after.
     # The normal flow is:
-    #   command() -> send_next() -> connectionMade() -> dataReceived()
-    #   -> disconnect() -> connectionLost() [ -> send_next() ... ]
+    #   TelldusOut.send_next() -> connectionMade() -> dataReceived()
+    #   -> connectionLost() -> TelldusOut.requestDone()
 
-    def __init__(self, parent):
-        self.log = Logger(namespace=parent.name+'/out')
+    def __init__(self, parent, request):
         self.parent = parent
-        self.master = parent.master
-        self.status = ColorState(log=self.log, state_format={0:0})  # <-- a hack to avoid color
-        self.status.add_callback(self.parent.update_status)
-        self.connected = False
+        self.log = parent.log
+        self.request = request
         self.completed = False
-        self.running = True
-        self.queue = []
-        self.active = None
-        self.factory = TelldusOutFactory(self, self.parent)
+        self.connected = False
+        self.factory = TelldusOutFactory(self, parent)
 
 
     def connectionMade(self):
-        if self.status.is_in('OFF'):
-            self.status.set_YELLOW('OUT connection made')
         self.connected = True
-        self.completed = False
-        self.send()
+        self.log.debug('{_dataout}', dataout=self.request.data)
+        self.transport.write(self.request.data)
 
 
     def connectionLost(self, reason):  # pylint: disable=W0222
         self.connected = False
-        if not self.completed:
-            # Lost connection before we could get any reply back.
-            self.log.error("Lost connection {p}: {e}",
-                           p=self.protocol.path, e=reason.getErrorMessage())
-            self.status.set_RED('Lost OUT connection')
-            (defer, self.defer) = (self.defer, None)
-            defer.errback(NoConnectionException(reason.getErrorMessage()))
-        self.completed = False
-        if self.running:
-            self.send_next(proceed=True)
-
-
-    def clientConnectionFailed(self, reason):
-        self.log.error('Connection failed {p}: {e}',
-                       p=self.protocol.path, e=reason.getErrorMessage())
-        self.status.set_RED('OUT connection failed')
-        (defer, self.defer) = (self.defer, None)
-        defer.errback(NoConnectionException(reason.getErrorMessage()))
-        self.send_next(proceed=True)
+        self.parent.connectionLost(self, reason)
 
 
     def disconnect(self):
         if self.connected:
-            self.running = False
             self.transport.loseConnection()
-        self.status.set_OFF('Done')
 
 
     def dataReceived(self, data):
-        self.status.set_GREEN()
         self.log.debug('{_rawin}', rawin=data)
         (elements, data) = parsestream(data)
-
-        # FIXME: Is it correct to send element to the callback? ....yes
-        (defer, self.defer) = (self.defer, None)
-        defer.callback(elements)
-
         self.completed = True
+        self.parent.requestDone(self, elements)
         self.transport.loseConnection()
 
 
+
+class TelldusOut(object):
+    ''' Class for outgoing Telldus commands. The commands are run over a pool
+        of at most 'concurrency' simultaneous client connections. Commands
+        for the same device are run in order, and a command replaces any
+        not yet dispatched command for the same device.
+    '''
+
+    path = '/tmp/TelldusClient'
+    timeout = 5
+
+    # Commands which operate on a device given by the first argument
+    DEVICE_COMMANDS = ('tdTurnOn', 'tdTurnOff', 'tdDim')
+
+
+    def __init__(self, parent, concurrency=4):
+        self.log = Logger(namespace=parent.name+'/out')
+        self.parent = parent
+        self.master = parent.master
+        self.status = ColorState(log=self.log, state_format={0:0})  # <-- a hack to avoid color
+        self.status.add_callback(self.parent.update_status)
+        self.concurrency = max(1, concurrency)
+        self.running = True
+        self.queue = []
+        self.pending = {}   # Queued requests by key
+        self.active = {}    # Running clients by request key
+
+
+    def clientConnectionFailed(self, client, reason):
+        self.log.error('Connection failed {p}: {e}',
+                       p=self.path, e=reason.getErrorMessage())
+        self.status.set_RED('OUT connection failed')
+        if self.finish(client):
+            client.request.errback(NoConnectionException(reason.getErrorMessage()))
+        self.send_next()
+
+
+    def connectionLost(self, client, reason):
+        if not client.completed and self.finish(client):
+            # Lost connection before we could get any reply back.
+            self.log.error("Lost connection {p}: {e}",
+                           p=self.path, e=reason.getErrorMessage())
+            self.status.set_RED('Lost OUT connection')
+            client.request.errback(NoConnectionException(reason.getErrorMessage()))
+        self.send_next()
+
+
+    def requestDone(self, client, elements):
+        if self.finish(client):
+            self.status.set_GREEN()
+            client.request.callback(elements)
+
+
+    def finish(self, client):
+        ''' Remove the client from the active list. Returns False if the
+            client is not active, i.e. it has been timed out.
+        '''
+        if self.active.get(client.request.key) is not client:
+            return False
+        del self.active[client.request.key]
+        return True
+
+
+    def disconnect(self):
+        self.running = False
+        for client in list(self.active.values()):
+            client.disconnect()
+        self.status.set_OFF('Done')
+
+
     def command(self, cmd):
         defer = Deferred()
-        self.queue.append((defer, cmd, generate(cmd)))
-        add_defer_timeout(self.master.reactor, defer, self.timeout, self.timedout, defer)
+
+        # Replace any not yet dispatched command to the same device
+        key = cmd
+        if cmd[0] in self.DEVICE_COMMANDS:
+            key = cmd[1]
+        request = self.pending.get(key)
+        if request is not None:
+            self.log.debug("Command '{o}' replaced by '{c}'", o=request.cmd, c=cmd)
+            request.cmd = cmd
+            request.data = generate(cmd)
+        else:
+            request = TelldusRequest(cmd, key)
+            request.timer = self.master.reactor.callLater(self.timeout, self.timedout, request)
+            self.queue.append(request)
+            self.pending[key] = request
+        request.defers.append(defer)
 
         # Send the next package
         self.send_next()
         return defer
 
 
-    def send(self):
-        self.log.debug('{_dataout}', dataout=self.data)
-        self.transport.write(self.data)
+    def send_next(self):
+        if not self.running:
+            return
+        for request in list(self.queue):
+            if len(self.active) >= self.concurrency:
+                return
 
+            # Commands to the same device must not overtake each other
+            if request.key in self.active:
+                continue
 
-    def send_next(self, proceed=False):
-        if self.active and not proceed:
-            return
-        self.active = None
-        self.defer = None
-        if len(self.queue):
-            (self.defer, self.active, self.data) = self.queue.pop(0)
+            self.queue.remove(request)
+            del self.pending[request.key]
+            client = TelldusClient(self, request)
+            self.active[request.key] = client
 
             # Next will be connectionMade() or clientConnectionFailed()
-            self.master.reactor.connectUNIX(self.path, self.factory)
+            self.master.reactor.connectUNIX(self.path, client.factory)
 
 
-    def timedout(self, defer):
+    def timedout(self, request):
         # The timeout response is to fail the request and proceed with the next command
-        self.log.err("Command '{c}' timed out", c=self.active)
-        self.disconnect()
+        self.log.error("Command '{c}' timed out", c=request.cmd)
         self.status.set_RED('Timeout')
-        defer.errback(TimeoutException())
-        self.send_next(proceed=True)
+        if self.pending.get(request.key) is request:
+            del self.pending[request.key]
+            self.queue.remove(request)
+        client = self.active.get(request.key)
+        if client is not None and client.request is request:
+            del self.active[request.key]
+            client.disconnect()
+        request.errback(TimeoutException())
+        self.send_next()
 
 
 
@@ -372,6 +562,7 @@ class Telldus(Node):
     CONFIG = {
         'config': dict(default=[], help='Telldus configuration', type=list),
         'double_protect': dict(default=1.0, help='Protection time to prevent double triggering', type=float),
+        'concurrency': dict(default=4, help='Max number of simultaneous Telldus commands', type=int),
     }
 
 
@@ -379,16 +570,31 @@ class Telldus(Node):
     def setup(self):
 
         self.doubleprotect = self.master.config.get('double_protect', name=self.name)
-        self.emitted = {}
+
+        # The protection time, whether to include the event args in the
+        # protection and the tolerance of numeric args, by event. See
+        # sendEvent()
+        self.protect = {}
+        for (ev, d) in self.events.items():
+            self.protect[ev] = (d.get('double_protect', self.doubleprotect),
+                                d.get('double_protect_args', False),
+                                d.get('double_protect_delta'))
+
+        # The args of the last emitted event, for events with a tolerance
+        self.emitted_args = {}
+
+        self.emitted = TimingWheel(self.master.reactor, resolution=PROTECT_RESOLUTION,
+                                   log=self.log)
 
         self.inport = TelldusIn(self)
-        self.outport = TelldusOut(self)
+        self.outport = TelldusOut(self, self.master.config.get('concurrency', name=self.name))
         self.inport.connect()
 
     def close(self):
         Node.close(self)
         self.inport.disconnect()
         self.outport.disconnect()
+        self.emitted.clear()
 
 
     # --- Callbacks
@@ -446,16 +652,8 @@ class Telldus(Node):
                 if 'method' in args:
                     args['method'] = args['method'].replace('turn', '')
 
-                # Traverse events list
-                for (ev, d) in self.events.items():
-
-                    # Ignore everything not an in device
-                    if d['protocol'] not in ('arctech',):
-                        continue
-
-                    # Compare the following attributes
-                    if not cmp_dict(args, d, ('house', 'group', 'unit', 'method')):
-                        continue
+                ev = self.match_event('arctech', args)
+                if ev is not None:
 
                     # Match found, process it as an event
                     self.sendEvent(ev)
@@ -464,16 +662,8 @@ class Telldus(Node):
 
             elif args['protocol'] == 'sartano':
 
-                # Traverse events list
-                for (ev, d) in self.events.items():
-
-                    # Ignore everything not this type
-                    if d['protocol'] not in ('sartano',):
-                        continue
-
-                    # Compare the following attributes
-                    if not cmp_dict(args, d, ('code', )):
-                        continue
+                ev = self.match_event('sartano', args)
+                if ev is not None:
 
                     # Match found, process it as an event
                     self.sendEvent(ev)
@@ -482,16 +672,9 @@ class Telldus(Node):
 
             elif args['protocol'] in ('mandolyn', 'fineoffset', 'oregon'):
 
-                # Traverse events list
-                for (ev, d) in self.events.items():
-
-                    # Only consider temp devices
-                    if d['protocol'] not in ('temp', ):
-                        continue
-
-                    # Compare the following attributes
-                    if not cmp_dict(args, d, ('id', )):
-                        continue
+                # Only consider temp devices
+                ev = self.match_event('temp', args)
+                if ev is not None:
 
                     # Match found, process it as an event
                     if 'humidity' in args:
@@ -508,20 +691,44 @@ class Telldus(Node):
         self.inport.log.info("Ignoring '{c}' {e}", c=cmd, e=event[1:])
 
 
+    def match_event(self, protocol, args):
+        ''' Return the name of the configured event of the given protocol
+            matching the raw event args, or None if no match
+        '''
+        index = self.event_index.get(protocol)
+        if index is None:
+            return None
+        return index.get(event_key(args, EVENT_MATCH[protocol]))
+
+
     # --- Override default sendEvent
     def sendEvent(self, event, *args):
         self.inport.log.info("Event '{e}'", e=event)
-        if event in self.emitted:
+
+        # Events with 'double_protect_args' set are only filtered when
+        # repeated with the same args, e.g. the same temperature. With
+        # 'double_protect_delta' set, numeric args within the delta of the
+        # last emitted event count as the same, e.g. temperature jitter.
+        (protect, use_args, delta) = self.protect.get(event, (self.doubleprotect, False, None))
+        if delta is not None:
+            key = event
+            double = key in self.emitted and args_within(self.emitted_args.get(event),
+                                                         args, delta)
+        else:
+            key = (event, args) if use_args else event
+            double = key in self.emitted
+
+        if double:
             self.inport.log.info("Event '{e}' double triggered", e=event)
             return
 
-        # Prevent double-triggering of events by starting a timer. As long
-        # as the timer runs, any additional events of the same type will
-        # be filtered.
-        def del_protect(event):
-            del self.emitted[event]
-        self.emitted[event] = True
-        self.master.reactor.callLater(self.doubleprotect, del_protect, event)
+        # Prevent double-triggering of events by adding it to the timing
+        # wheel. As long as it is present, any additional events of the
+        # same type will be filtered.
+        if protect > 0:
+            self.emitted.add(key, protect, lambda: None)
+            if delta is not None:
+                self.emitted_args[event] = args
         Node.sendEvent(self, event, *args)
 
 
@@ -565,6 +772,27 @@ class Telldus(Node):
             d = eq.copy()
             d.update(**kw)
             d['name'] = name = d['name'].format(**d)
+            if 'double_protect' in d:
+                try:
+                    d['double_protect'] = float(d['double_protect'])
+                except (TypeError, ValueError):
+                    raise ConfigException("telldus_config:%s: "
+                                          "Invalid double_protect '%s'"
+                                          %(d['i'], d['double_protect']))
+            if 'double_protect_delta' in d:
+                try:
+                    d['double_protect_delta'] = float(d['double_protect_delta'])
+                except (TypeError, ValueError):
+                    raise ConfigException("telldus_config:%s: "
+                                          "Invalid double_protect_delta '%s'"
+                                          %(d['i'], d['double_protect_delta']))
+            if 'double_protect_args' in d:
+                try:
+                    d['double_protect_args'] = BOOLEANS[d['double_protect_args']]
+                except (KeyError, TypeError):
+                    raise ConfigException("telldus_config:%s: "
+                                          "Invalid double_protect_args '%s', expecting true or false"
+                                          %(d['i'], d['double_protect_args']))
             #if name in self.events:
             #    raise ConfigException("telldus_config:%s: "
             #                          "Event '%s' already in list"
@@ -624,6 +852,16 @@ class Telldus(Node):
                                       "Unknown telldus equipment protocol %s"
                                       %(i+1, t))
 
+        # -- Index the events by protocol and their match attributes, for
+        #    looking up the incoming raw events
+        self.event_index = {}
+        for (ev, d) in self.events.items():
+            attrs = EVENT_MATCH.get(d['protocol'])
+            if attrs is None:
+                continue
+            index = self.event_index.setdefault(d['protocol'], {})
+            index.setdefault(event_key(d, attrs), ev)
+
 
 # FIXME: Implement ability to generate tellstick.conf from telldus_config
 
@@ -4,7 +4,12 @@ from __future__ import absolute_import, division, print_function
 
 import os
 import json
+from collections import deque
+from fnmatch import fnmatchcase
 
+from zope.interface import implementer
+from twisted.internet.interfaces import IPushProducer
+from twisted.internet.task import LoopingCall
 from twisted.web.resource import Resource, ErrorPage
 from twisted.web.server import Site, NOT_DONE_YET
 import twisted.web.http as http
@@ -20,6 +25,9 @@ from lumina.exceptions import TimeoutException
 
 COMMAND_TIMEOUT = 10
 
+# Topics sent to event stream clients that do not give any filters
+STREAM_FILTERS = ('status', 'node_status', 'plugin/*', 'node/*')
+
 
 def getPath(request):
     if request.postpath:
@@ -114,19 +122,136 @@ class RestCommand(LuminaResource):
 
 
 class RestInfo(LuminaResource):
-    ''' REST interface resource '''
+    ''' REST interface resource. The local info is served from the cached
+        snapshots, and supports conditional requests by ETag.
+    '''
     def render_GET(self, request):
         request.setHeader(b'Content-Type', b'application/json')
-        request.setHeader(b'Cache-Control', b'no-cache, no-store, must-revalidate')
+        request.setHeader(b'Cache-Control', b'no-cache')
         path = getPath(request)
 
-        if path == '':
-            path = '_info'
+        if path in ('', '_info'):
+            return self.web_snapshot(request, self.master.info)
+        if path == '_server':
+            return self.web_snapshot(request, self.master_server.info)
+
         # All others refer to remote nodes
-        if path not in ('_info', '_server'):
-            path = path + '/_info'
+        request.setHeader(b'Cache-Control', b'no-cache, no-store, must-revalidate')
+        command = Message.create('command', path + '/_info')
+
+        def reply_ok(result):  # pylint: disable=unused-variable
+            request.write(json.dumps(result).encode('utf-8'))
+            request.finish()
+
+        def reply_error(failure):  # pylint: disable=unused-variable
+            request.setResponseCode(http.BAD_REQUEST)
+            request.write(command.dump_json())
+            request.finish()
+
+        self.run_command(command).addCallback(reply_ok).addErrback(reply_error)
+        return NOT_DONE_YET
+
+
+    def web_snapshot(self, request, snapshot):
+        ''' Reply with the snapshot, or with 304 if the client has it '''
+        (etag, data) = snapshot.json()
+        if request.setETag(etag) == http.CACHED:
+            return b''
+        return data
+
+
+
+@implementer(IPushProducer)
+class StreamClient(object):
+    ''' A client of the event stream. Messages are written directly while the
+        connection accepts more data. When the client is slow, the messages
+        are queued in a bounded backlog, dropping the oldest.
+    '''
+
+    def __init__(self, request, filters, backlog):
+        self.request = request
+        self.filters = filters
+        self.matched = {}
+        self.backlog = deque(maxlen=backlog)
+        self.paused = False
+        self.dropped = 0
+
+
+    def matches(self, topic):
+        ''' Return True if the topic is selected by the filters '''
+        match = self.matched.get(topic)
+        if match is None:
+            match = any(fnmatchcase(topic, f) for f in self.filters)
+            self.matched[topic] = match
+        return match
+
+
+    def write(self, data):
+        ''' Write the data to the client or queue it if the client is slow '''
+        if not self.paused:
+            self.request.write(data)
+            return
+        if len(self.backlog) == self.backlog.maxlen:
+            self.dropped += 1
+        self.backlog.append(data)
+
+
+    def pauseProducing(self):
+        self.paused = True
+
+
+    def resumeProducing(self):
+        self.paused = False
+
+        # Tell the client that messages have been lost, so it can reload
+        if self.dropped:
+            self.request.write(('event: overflow\ndata: %s\n\n' %(
+                json.dumps({'dropped': self.dropped}),)).encode('utf-8'))
+            self.dropped = 0
+
+        while self.backlog and not self.paused:
+            self.request.write(self.backlog.popleft())
+
+
+    def stopProducing(self):
+        self.paused = True
+        self.backlog.clear()
+
+
+
+class EventStream(LuminaResource):
+    ''' Server-sent events stream of status changes, node changes and events.
+        The topics to receive are selected by the 'filter' query arguments,
+        which are comma separated patterns, e.g. ?filter=node/*,event/led/*
+    '''
+
+    def __init__(self, parent):
+        LuminaResource.__init__(self, parent)
+        self.web = parent
+
+
+    def render_GET(self, request):
+        web = self.web
+        if len(web.streams) >= web.stream_clients:
+            return ErrorPage(http.SERVICE_UNAVAILABLE, 'Error',
+                             'Too many stream clients').render(request)
+
+        filters = []
+        for arg in request.args.get('filter', []):
+            filters.extend(f for f in arg.split(',') if f)
+
+        request.setHeader(b'Content-Type', b'text/event-stream')
+        request.setHeader(b'Cache-Control', b'no-cache')
+
+        client = StreamClient(request, tuple(filters) or STREAM_FILTERS,
+                              web.stream_backlog)
+        request.registerProducer(client, True)
+        request.write(b'retry: 5000\n\n')
+
+        web.add_stream(client)
+        request.notifyFinish().addBoth(lambda a: web.remove_stream(client))
+        return NOT_DONE_YET
 
-        return self.web_command(request, Message.create('command'. path))
 
 
 # Fix issue with asset caching. Not elegant, but works for now
@@ -146,15 +271,33 @@ class Web(Plugin):
         'port': dict(default=8081, help='Web server port', type=int),
         'root': dict(default=os.getcwd()+'/www', help='Path for web server files'),
         'log': dict(default='access-lumina.log', help='Path for web server logs'),
+        'stream_clients': dict(default=50, help='Max number of event stream clients', type=int),
+        'stream_backlog': dict(default=100, help='Max number of messages queued '
+                               'for a slow event stream client', type=int),
+        'stream_keepalive': dict(default=30, help='Interval in seconds between '
+                                 'keepalives on the event stream', type=int),
     }
 
     DEPENDS = ('server', 'responder')
 
+    def __init__(self):
+        # Event stream clients
+        self.streams = []
+
+
     def setup(self):
 
         self.port = self.master.config.get('port', name=self.name)
         self.webroot = self.master.config.get('root', name=self.name)
         self.logpath = self.master.config.get('log', name=self.name)
+        self.stream_clients = self.master.config.get('stream_clients', name=self.name)
+        self.stream_backlog = self.master.config.get('stream_backlog', name=self.name)
+        self.stream_keepalive = self.master.config.get('stream_keepalive', name=self.name)
+
+        # Id of the last message on the event stream
+        self.stream_id = 0
+        self.keepalive = LoopingCall(self.send_keepalive)
+        self.keepalive.clock = self.master.reactor
 
         # Creste the root object
         root = LumFile(self.webroot)
@@ -164,6 +307,7 @@ class Web(Plugin):
         # List of resources that we want added
         resources = {'rest/command': RestCommand(self),
                      'rest/info': RestInfo(self),
+                     'rest/stream': EventStream(self),
                     }
 
         # Traverse all resources and add them to the tree. Add empty
@@ -193,9 +337,80 @@ class Web(Plugin):
 
         self.log.info("Logging access in {p}", p=self.logpath)
 
+        # Subscribe to the changes sent on the event stream. Changes within
+        # the same reactor tick are collapsed.
+        reactor = self.master.reactor
+        server = self.master.get_plugin_by_module('server')
+        server.add_listener(self.publish)
+        server.node_status.add_callback(
+            lambda a: self.publish('node_status', self.status_info(a)),
+            reactor=reactor, window=0)
+        self.master.status.add_callback(
+            lambda a: self.publish('status', self.status_info(a)),
+            reactor=reactor, window=0)
+        for plugin in self.master.plugins.values():
+            plugin.status.add_callback(
+                lambda a: self.publish('plugin/' + a.name, self.status_info(a)),
+                reactor=reactor, window=0)
+
         # Ready
         self.status.set_GREEN()
 
 
+    def close(self):
+        Plugin.close(self)
+        for client in list(self.streams):
+            client.request.unregisterProducer()
+            client.request.finish()
+
+
+    # --- Event stream
+    def add_stream(self, client):
+        ''' Add a client to the event stream '''
+        self.streams.append(client)
+        if not self.keepalive.running:
+            self.keepalive.start(self.stream_keepalive, now=False)
+
+
+    def remove_stream(self, client):
+        ''' Remove a client from the event stream '''
+        if client in self.streams:
+            self.streams.remove(client)
+        if not self.streams and self.keepalive.running:
+            self.keepalive.stop()
+
+
+    def publish(self, topic, data):
+        ''' Send a message to the event stream clients selecting topic. The
+            message is encoded once for all clients.
+        '''
+        clients = [client for client in self.streams if client.matches(topic)]
+        if not clients:
+            return
+
+        self.stream_id += 1
+        message = ('id: %s\nevent: %s\ndata: %s\n\n' %(
+            self.stream_id, topic.split('/', 1)[0],
+            json.dumps({'topic': topic, 'data': data}))).encode('utf-8')
+        for client in clients:
+            client.write(message)
+
+
+    def send_keepalive(self):
+        ''' Keep the idle event stream connections open '''
+        for client in self.streams:
+            if not client.paused:
+                client.request.write(b': keepalive\n\n')
+
+
+    @staticmethod
+    def status_info(status):
+        ''' Return a dict of the status '''
+        return {
+            'status'    : status.state,
+            'status_why': str(status.why) if status.why is not None else None,
+        }
+
+
 
 PLUGIN = Web
@@ -3,22 +3,22 @@
 from __future__ import absolute_import, division, print_function
 
 import re
-try:
-    from queue import Queue
-except ImportError:
-    # Py2
-    from Queue import Queue
 import xml.etree.ElementTree as ET
 import socket
+from collections import deque
 
-from twisted.internet.defer import Deferred
+from twisted.internet.defer import Deferred, succeed
 from twisted.internet.protocol import DatagramProtocol, ClientFactory, Protocol
 #from twisted.web.client import Agent
 #from twisted.web.http_headers import Headers
 
 from lumina.node import Node
 from lumina.log import Logger
-from lumina.exceptions import LuminaException, CommandRunException, TimeoutException
+from lumina.compat import compat_str
+from lumina.state import StateCache, MISSING
+from lumina.cmdqueue import CommandQueue, PRIO_NORMAL, PRIO_LOW, OVERFLOW_DROP_OLDEST
+from lumina.exceptions import (LuminaException, CommandRunException, TimeoutException,
+                               QueueFullException, NoConnectionException)
 
 
 class SSDPException(LuminaException):
@@ -53,6 +53,27 @@ SPEAKER_DISTANCE2 = ('System', 'Speaker_Preout', 'Pattern_2', 'Distance')
 SPEAKER_PEQ1 = ('System', 'Speaker_Preout', 'Pattern_1', 'PEQ', 'Manual_Data')
 SPEAKER_PEQ2 = ('System', 'Speaker_Preout', 'Pattern_2', 'PEQ', 'Manual_Data')
 
+# Chains where the device state is cached, and the other chains which are
+# changed when setting it
+CACHED = {
+    POWER_ALL: (POWER_MAIN, ),
+    POWER_MAIN: (POWER_ALL, ),
+    VOLUME: (),
+    INPUT: (),
+    PURE_DIRECT: (),
+}
+
+# Notification properties and the chains they change
+NOTIFICATIONS = {
+    'Power': (POWER_ALL, POWER_MAIN),
+    'Volume': (VOLUME, ),
+    'Input': (INPUT, ),
+}
+
+# Chains where the GET response is mirrored. They are kept up to date by
+# the notifications.
+MIRRORED = frozenset(chain for chains in NOTIFICATIONS.values() for chain in chains)
+
 
 def dB(value):
     return {'Val': int(float(value)*10),
@@ -113,6 +134,15 @@ def ison(xml):
         return False
 
 
+# Notification properties, and the event, chain and parser of the state
+# fetched when notified
+STATE_EVENTS = {
+    'Power': ('power', POWER_ALL, ison),
+    'Volume': ('volume', VOLUME, parse_dB),
+    'Input': ('input', INPUT, t),
+}
+
+
 class YamahaSSDP(DatagramProtocol):
     noisy = False
     system = 'AVR'
@@ -176,146 +206,424 @@ class YamahaSSDP(DatagramProtocol):
 
 
 
+class HTTPResponse(object):
+    ''' A received HTTP response '''
+    __slots__ = ('code', 'reason', 'headers', 'body')
+
+    def __init__(self, code, reason):
+        self.code = code
+        self.reason = reason
+        self.headers = {}
+        self.body = None
+
+
+
+class HTTPResponseParser(object):
+    ''' Incremental HTTP/1.1 response parser. Data is added with feed(),
+        which returns the list of completed responses. The body is given by
+        either Content-Length, chunked transfer encoding or by the closing
+        of the connection, see close(). Raises ValueError on malformed data.
+    '''
+
+    re_status = re.compile(br'HTTP/\S+ (\d+) ?(.*)')
+
+
+    def __init__(self):
+        self.buf = bytearray()
+        self.offset = 0
+        self.state = 'status'
+        self.response = None
+        self.length = 0
+        self.chunks = []
+
+
+    def feed(self, data):
+        ''' Add data and return the list of completed responses '''
+        if self.offset:
+            del self.buf[:self.offset]
+            self.offset = 0
+        self.buf += data
+
+        responses = []
+        while True:
+            response = self.parse()
+            if response is None:
+                return responses
+            responses.append(response)
+
+
+    def close(self):
+        ''' Return the response terminated by the closing of the connection,
+            or None if there is none
+        '''
+        if self.state != 'close':
+            return None
+        return self.finish(bytes(self.buf[self.offset:]))
+
+
+    def readline(self):
+        end = self.buf.find(b'\r\n', self.offset)
+        if end < 0:
+            return None
+        line = bytes(self.buf[self.offset:end])
+        self.offset = end + 2
+        return line
+
+
+    def read(self, length):
+        if len(self.buf) - self.offset < length:
+            return None
+        data = bytes(self.buf[self.offset:self.offset+length])
+        self.offset += length
+        return data
+
+
+    def finish(self, body):
+        (response, self.response) = (self.response, None)
+        response.body = body
+        self.state = 'status'
+        return response
+
+
+    def parse(self):
+        ''' Parse the buffer and return the next completed response, or None
+            if more data is needed
+        '''
+        while True:
+
+            if self.state == 'status':
+                line = self.readline()
+                if line is None:
+                    return None
+                if not line:
+                    # Tolerate empty lines between responses
+                    continue
+                m = self.re_status.match(line)
+                if not m:
+                    raise ValueError("Malformed HTTP status line '%s'" %(line,))
+                self.response = HTTPResponse(int(m.group(1)), compat_str(m.group(2)))
+                self.state = 'header'
+
+            elif self.state == 'header':
+                line = self.readline()
+                if line is None:
+                    return None
+                if line:
+                    (key, sep, value) = line.partition(b':')
+                    if not sep:
+                        raise ValueError("Malformed HTTP header '%s'" %(line,))
+                    # Header names are case insensitive, so store them as
+                    # native lower case str
+                    self.response.headers[compat_str(key.strip()).lower()] = \
+                        compat_str(value.strip())
+                    continue
+
+                # End of header
+                headers = self.response.headers
+                if headers.get('transfer-encoding', '').lower() == 'chunked':
+                    self.chunks = []
+                    self.state = 'chunksize'
+                elif 'content-length' in headers:
+                    self.length = int(headers['content-length'])
+                    self.state = 'body'
+                else:
+                    self.state = 'close'
+
+            elif self.state == 'body':
+                body = self.read(self.length)
+                if body is None:
+                    return None
+                return self.finish(body)
+
+            elif self.state == 'chunksize':
+                line = self.readline()
+                if line is None:
+                    return None
+                self.length = int(line.split(b';')[0], 16)
+                self.state = 'chunk' if self.length else 'trailer'
+
+            elif self.state == 'chunk':
+                chunk = self.read(self.length + 2)
+                if chunk is None:
+                    return None
+                self.chunks.append(chunk[:-2])
+                self.state = 'chunksize'
+
+            elif self.state == 'trailer':
+                line = self.readline()
+                if line is None:
+                    return None
+                if not line:
+                    return self.finish(b''.join(self.chunks))
+
+            else:
+                # Body until the connection closes
+                return None
+
+
+
+class YamahaRequest(object):
+    ''' A request to the Yamaha '''
+
+    def __init__(self, command, chain, data=None):
+        self.command = command
+        self.chain = chain
+        self.data = data
+        self.defer = Deferred()
+
+        # Number of changes of the chain when a GET was issued
+        self.changes = None
+
+
+    def build(self, xml):
+        ''' Add the request to the XML document. Elements of the chain which
+            are the last ones in the document are shared.
+        '''
+        xmle = xml
+        for c in self.chain:
+            if len(xmle) and xmle[-1].tag == c:
+                xmle = xmle[-1]
+            else:
+                xmle = ET.SubElement(xmle, c)
+        if self.command == GET:
+            xmle.text = 'GetParam'
+        elif self.command == PUT:
+            if isinstance(self.data, dict):
+                for (k, v) in self.data.items():
+                    ET.SubElement(xmle, k).text = str(v)
+            else:
+                xmle.text = str(self.data)
+
+
+
+class YamahaBatch(object):
+    ''' One HTTP request to the Yamaha, carrying one or more requests of the
+        same command in one YAMAHA_AV document
+    '''
+
+    def __init__(self, request):
+        self.command = request.command
+        self.requests = []
+        self.xml = ET.Element(ROOT, attrib={'cmd': request.command})
+        self.timer = None
+        self.add(request)
+
+
+    def fits(self, request):
+        ''' Return True if request can be added to the batch. Only PUT requests
+            to separate subtrees are merged, and the order of the requests
+            must be kept in the document.
+        '''
+        if request.command != PUT or self.command != PUT:
+            return False
+        chain = request.chain
+        for other in self.requests:
+            n = min(len(chain), len(other.chain))
+            if chain[:n] == other.chain[:n]:
+                return False
+        xmle = self.xml
+        for c in chain:
+            if not len(xmle) or xmle[-1].tag != c:
+                return xmle.find(c) is None
+            xmle = xmle[-1]
+        return False
+
+
+    def add(self, request):
+        request.build(self.xml)
+        self.requests.append(request)
+
+
+    def body(self):
+        return ET.tostring(self.xml, encoding='utf-8')
+
+
+    def cancel(self):
+        if self.timer is not None and self.timer.active():
+            self.timer.cancel()
+
+
+    def errback(self, exc):
+        self.cancel()
+        for request in self.requests:
+            request.defer.errback(exc)
+
+
+
 class YamahaFactory(ClientFactory):
     noisy = False
 
-    def __init__(self, protocol, parent):
-        self.log = protocol.log
-        self.protocol = protocol
+    def __init__(self, parent):
+        self.log = parent.log
         self.parent = parent
 
     def buildProtocol(self, addr):
-        return self.protocol
+        return YamahaClient(self.parent)
 
     def clientConnectionFailed(self, connector, reason):
-        self.protocol.clientConnectionFailed(reason)
+        self.parent.clientConnectionFailed(reason)
 
 
 
-class YamahaProtocol(Protocol):
+class YamahaClient(Protocol):
+    ''' A persistent HTTP connection to the Yamaha '''
     noisy = False
-    timeout = 5
 
-    def __init__(self, parent, host, port):
+    def __init__(self, parent):
+        self.parent = parent
+        self.log = parent.log
+        self.parser = HTTPResponseParser()
+
+
+    def connectionMade(self):
+        self.parent.clientConnectionMade(self)
+
+
+    def connectionLost(self, reason):  # pylint: disable=W0222
+        # This will catch up responses terminated by server-side close
+        response = self.parser.close()
+        if response is not None:
+            self.parent.responseReceived(response)
+        self.parent.clientConnectionLost(self, reason)
+
+
+    def dataReceived(self, data):
+        self.log.debug("RAW  >>>  ({l})'{d}'", l=len(data), d=data)
+        try:
+            responses = self.parser.feed(data)
+        except ValueError as e:
+            self.log.info("Malformed HTTP response. {m}.", m=str(e))
+            self.transport.loseConnection()
+            return
+        for response in responses:
+            self.parent.responseReceived(response)
+
+
+
+class YamahaProtocol(object):
+    ''' Yamaha control interface. The requests are sent over a persistent
+        HTTP connection, which is (re)connected when there are requests to
+        send. Up to 'pipeline' requests can be sent before the responses
+        have been received. Consecutive queued PUT requests are merged into
+        one request of up to 'batch' commands.
+    '''
+    timeout = 5
+    cache_lifetime = 120
+    queue_size = 32
+
+    HTTP_REQUEST = ('POST /YamahaRemoteControl/ctrl HTTP/1.1\r\n'
+                    'Host: %s\r\n'
+                    'Content-Type: text/xml; charset="utf-8"\r\n'
+                    'Content-Length: %s\r\n'
+                    'Connection: keep-alive\r\n'
+                    '\r\n'
+                    '%s')
+
+    def __init__(self, parent, host, port, pipeline=1, batch=1):
         self.log = Logger(namespace=parent.name+'/main')
         self.parent = parent
         self.master = parent.master
         self.status = parent.status
         self.host = host
         self.port = port
-        self.queue = Queue()
-        self.factory = YamahaFactory(self, self.parent)
-
-        self.re_http = re.compile(r'HTTP/\S+ (\d+) (.*)')
-        self.re_header = re.compile(r'\s*(\S+)\s*:\s*(.*)\s*')
-
-        self.defer = None
-
-
-    def connectionMade(self):
+        self.pipeline = max(1, pipeline)
+        self.batch = max(1, batch)
+        self.queue = CommandQueue(self.master.reactor, maxsize=self.queue_size,
+                                  overflow=OVERFLOW_DROP_OLDEST, dropped=self.dropped)
+        parent.queues['device'] = self.queue
+        self.factory = YamahaFactory(self)
+        self.cache = StateCache(self.master.reactor, lifetime=self.cache_lifetime)
+        self.mirror = StateCache(self.master.reactor, lifetime=self.cache_lifetime)
+
+        # Number of PUTs issued per cached chain. A GET response only records
+        # the state if the chain has not been changed since the GET was
+        # issued, as the response might be older than the change.
+        self.changes = {}
+
+        self.running = True
+        self.client = None
+        self.connecting = False
+        self.closing = False
+        self.inflight = deque()
+        self.retry = deque()
+
+
+    def clientConnectionMade(self, client):
         self.log.info("Connection made")
-        body = self.lastbody
-        myip = self.transport.getHost().host
-        data = '''POST /YamahaRemoteControl/ctrl HTTP/1.1\r
-Host: %s\r
-Content-Type: text/xml; charset="utf-8"\r
-Content-Length: %s\r
-Connection: keep-alive\r
-\r
-%s''' %(myip, len(body), body)
-        #log.msg( "     <<<  %s" %(self.queue.active['chain']), system=self.system)
-        self.log.debug("     <<<  '{b}'", b=body)
-        #log.msg("RAW  <<<  (%s)'%s'" %(len(data),data), system=self.system)
-        self.data = ''
-        self.dstate = 'http'
-        self.length = 0
-        self.header = {}
-        self.transport.write(data)
+        self.client = client
+        self.connecting = False
+        self.closing = False
+        self.send_next()
 
 
-    def connectionLost(self, reason):  # pylint: disable=W0222
+    def clientConnectionLost(self, client, reason):
         self.log.info("Connection lost: {e}", e=reason.getErrorMessage())
-        #self.setstate('closed', reason.getErrorMessage())
-        # This will catch up server-side close and 0 length body packages
-        if self.dstate != 'done':
-            self.slurp_body()
+        self.client = None
+
+        # The requests in progress will not be replied
+        (inflight, self.inflight) = (self.inflight, deque())
+        for batch in inflight:
+            batch.errback(NoConnectionException(reason.getErrorMessage()))
+
+        # Reconnect if there are more requests
+        self.send_next()
 
 
     def clientConnectionFailed(self, reason):
         self.log.info("Connection failed: {e}", e=reason.getErrorMessage())
+        self.status.set_RED('Connection failed')
+        self.connecting = False
+        self.fail_queued(NoConnectionException(reason.getErrorMessage()))
 
 
     def disconnect(self):
-        #if self.state in ('connected','active'):
-        if self.transport:
-            self.transport.loseConnection()
+        self.running = False
+        self.fail_queued(NoConnectionException('Disconnected'))
+        if self.client:
+            self.client.transport.loseConnection()
 
 
-    def dataReceived(self, data):
-        #self.setstate('active')
-        self.data += data
-        self.log.debug("RAW  >>>  ({l})'{d}'", l=len(data), d=data)
+    def fail_queued(self, exc):
+        ''' Fail the requests waiting to be sent '''
+        (retry, self.retry) = (self.retry, deque())
+        for batch in retry:
+            batch.errback(exc)
+        for request in self.queue.clear():
+            request.defer.errback(exc)
 
-        # Body part of the frame
-        if self.dstate == 'body':
-            self.slurp_body()
-            return
 
-        while True:
-            # Get the next line and exit the loop if no more lines found
-            pat = '\r\n'
-            sub = self.data.find(pat)
-            if sub < 0:
-                return
-            line = self.data[0:sub]
-            self.data = self.data[sub+len(pat)::]
-
-            # First line (HTML protocol)
-            if self.dstate == 'http':
-                m = self.re_http.search(line)
-                if not m:
-                    raise Exception("Malformed HTTP header")
-                self.httperr = int(m.group(1))
-                self.httptxt = m.group(2)
-                self.dstate = 'header'
-
-            # Header
-            elif self.dstate == 'header':
-                if len(line) == 0:
-                    self.dstate = 'body'
-                    self.length = int(self.header['Content-Length'])
-                    self.slurp_body()
-                else:
-                    m = self.re_header.search(line)
-                    if not m:
-                        raise Exception("Malformed HTML header")
-                    self.header[m.group(1)] = m.group(2)
-
-
-    def slurp_body(self):
-
-        # Enough data?
-        if not len(self.data) or len(self.data) < self.length:
+    def responseReceived(self, response):
+        if not self.inflight:
+            self.log.info("Unexpected response, ignoring")
             return
-        body = self.data[0:self.length]
-        self.dstate = 'done'
+        batch = self.inflight.popleft()
+        batch.cancel()
+
+        # The server will close the connection after this response
+        if response.headers.get('connection', '').lower() == 'close':
+            self.closing = True
 
-        # Got what we want, so let's close the connection
-        self.disconnect()
+        # Close the connection from this end as well after the last
+        # response, so the waiting requests are sent on a new connection
+        # even if the server doesn't close it
+        if self.closing and not self.inflight:
+            self.client.transport.loseConnection()
 
         try:
             # Check http error code
-            if self.httperr == 400:
-                raise CommandRunException('HTML err %s, Bad request, XML Parse error' %(self.httperr,))
+            if response.code == 400:
+                raise CommandRunException('HTML err %s, Bad request, XML Parse error' %(response.code,))
+            if response.code != 200:
+                raise CommandRunException('HTML err %s, %s' %(response.code, response.reason))
 
-            self.log.debug("     >>>  '{b}'", b=body)
-            xml = ET.fromstring(body)
+            self.log.debug("     >>>  '{b}'", b=response.body)
+            xml = ET.fromstring(response.body)
             if xml.tag != ROOT:
                 raise CommandRunException("'%s' is XML root, not '%s'" %(xml.tag, ROOT))
 
             # Response to our object?
             rsp = xml.attrib['rsp']
-            command = self.lastcommand
+            command = batch.command
             if rsp != command:
                 raise CommandRunException("Response is '%s', command was '%s'" %(rsp, command))
 
@@ -327,84 +635,149 @@ Connection: keep-alive\r
             if err != 'OK':
                 raise CommandRunException(err)
 
+        except (ET.ParseError, CommandRunException) as e:
+            for request in batch.requests:
+                self.invalidate(request.chain)
+
+            # The return code doesn't tell which of the merged requests
+            # failed, so retry them one by one
+            if len(batch.requests) > 1 and isinstance(e, CommandRunException):
+                self.log.info("Batch of {n} commands failed, retrying individually. {m}.",
+                              n=len(batch.requests), m=str(e))
+                self.retry.extend(YamahaBatch(request) for request in batch.requests)
+            else:
+                self.log.info("Command failed. {m}.", m=str(e))
+                batch.errback(e)
+
+            # Process next command
+            self.send_next()
+            return
+
+        self.parent.status.set_GREEN()
+        for request in batch.requests:
+
             # Unwind the chain
-            chain = self.lastchain
+            chain = request.chain
             xmle = xml
             for c in chain:
                 sub = xmle.find(c)
                 if sub is None:
-                    raise CommandRunException("Response XML does not match request on level '%s'" %(c,))
+                    e = CommandRunException("Response XML does not match request on level '%s'" %(c,))
+                    self.log.info("Command failed. {m}.", m=str(e))
+                    self.invalidate(chain)
+                    request.defer.errback(e)
+                    break
                 xmle = sub
-
-            #log.msg("     >>>  '%s'" %(ET.tostring(xmle),), system=self.system)
-
-            if command == PUT:
-                self.parent.status.set_GREEN()
-                self.defer.callback(xmle.text)
             else:
-                self.parent.status.set_GREEN()
-                self.defer.callback(xmle)
-
-        except (ET.ParseError, CommandRunException) as e:
-            self.log.info("Command failed. {m}.", m=str(e))
-            self.defer.errback(e)
+                # Record the confirmed state. The mirrored GET response of
+                # the chain and the chains changed with it are now stale.
+                if command == PUT:
+                    if chain in CACHED:
+                        self.cache.set(chain, request.data)
+                        self.mirror.invalidate(chain, *CACHED[chain])
+                elif request.changes == self.changes.get(chain, 0):
+                    if chain in CACHED and len(xmle) == 0:
+                        self.cache.set(chain, xmle.text)
+                    if chain in MIRRORED:
+                        self.mirror.set(chain, xmle)
+
+                if command == PUT:
+                    request.defer.callback(xmle.text)
+                else:
+                    request.defer.callback(xmle)
 
         # Process next command
-        self.timer.cancel()
-        self.defer = None
         self.send_next()
 
 
-    def command(self, command, chain, data=None):
-        # Compile an XML request
-        xml = ET.Element(ROOT, attrib={'cmd': command})
-        xmle = xml
-        for c in chain:
-            xmle = ET.SubElement(xmle, c)
-        if command == GET:
-            xmle.text = 'GetParam'
-        elif command == PUT:
-            if isinstance(data, dict):
-                for (k, v) in data.items():
-                    ET.SubElement(xmle, k).text = str(v)
-            else:
-                xmle.text = str(data)
+    def command(self, command, chain, data=None, priority=PRIO_NORMAL, cached=True):
+        chain = tuple(chain)
 
-        body = ET.tostring(xml, encoding='utf-8')
+        # Answer from the state mirror if it is fresh
+        if command == GET and cached:
+            xmle = self.mirror.get(chain)
+            if xmle is not None:
+                return succeed(xmle)
 
-        defer = Deferred()
-        self.queue.put((defer, command, chain, body))
+        # Don't set states the device is known to have. The state is unknown
+        # until the command has completed.
+        if command == PUT and chain in CACHED:
+            if self.cache.is_set(chain, data):
+                self.log.debug("{c} is already '{d}', skipping", c='/'.join(chain), d=data)
+                return succeed(None)
+            self.invalidate(chain, *CACHED[chain])
+            for c in (chain, ) + CACHED[chain]:
+                self.changes[c] = self.changes.get(c, 0) + 1
+
+        request = YamahaRequest(command, chain, data)
+        if command == GET:
+            request.changes = self.changes.get(chain, 0)
+        self.queue.put(request, priority)
         self.send_next()
-        return defer
+        return request.defer
 
 
     def send_next(self):
+        if not self.running or not (self.retry or len(self.queue)):
+            return
 
-        # Don't send new if communication is pending
-        if self.defer:
+        # Connect if needed. Next will be clientConnectionMade() or
+        # clientConnectionFailed()
+        if self.client is None:
+            if not self.connecting:
+                self.connecting = True
+                self.master.reactor.connectTCP(self.host, self.port, self.factory)
             return
 
-        while self.queue.qsize():
-            (defer, command, chain, body) = self.queue.get(False)
+        # Don't send on a connection that is about to be closed
+        while (self.retry or len(self.queue)) and len(self.inflight) < self.pipeline \
+              and not self.closing:
+
+            # Retried requests are sent one by one, otherwise merge the
+            # following queued requests that fit
+            if self.retry:
+                batch = self.retry.popleft()
+            else:
+                batch = YamahaBatch(self.queue.get())
+                while len(self.queue) and len(batch.requests) < self.batch \
+                      and batch.fits(self.queue.peek()):
+                    batch.add(self.queue.get())
 
             # Send the command
-            self.master.reactor.connectTCP(self.host, self.port, self.factory)
+            body = batch.body()
+            self.log.debug("     <<<  '{b}'", b=body)
+            self.client.transport.write(self.HTTP_REQUEST %(self.host, len(body), body))
 
             # Expect reply
-            self.lastcommand = command
-            self.lastchain = chain
-            self.lastbody = body
-            self.defer = defer
-            self.timer = self.master.reactor.callLater(self.timeout, self.timedout)
-            return
+            batch.timer = self.master.reactor.callLater(self.timeout, self.timedout, batch)
+            self.inflight.append(batch)
 
 
-    def timedout(self):
-        # The timeout response is to fail the request and proceed with the next command
+    def timedout(self, batch):
+        # The timeout response is to fail the request. The responses of any
+        # pipelined requests can no longer be trusted, so drop the connection,
+        # which will fail them as well.
         self.log.info("Communication timed out.")
         self.status.set_RED('Timeout')
-        self.defer.errback(TimeoutException())
-        self.send_next()
+        self.invalidate()
+        self.inflight.remove(batch)
+        batch.errback(TimeoutException())
+        if self.client:
+            self.client.transport.loseConnection()
+
+
+    def invalidate(self, *chains):
+        ''' Forget the known device state of the given chains, or all if no
+            chains are given
+        '''
+        self.cache.invalidate(*chains)
+        self.mirror.invalidate(*chains)
+
+
+    def dropped(self, request):
+        ''' Fail a command dropped from the full queue '''
+        self.log.info("Queue full, dropping command")
+        request.defer.errback(QueueFullException())
 
 
 
@@ -417,8 +790,20 @@ class Yamaha(Node):
         'port'     : dict(default=80, help='Yamaha port', type=int),
         'ssdp'     : dict(default='239.255.255.250', help='Yamaha SSDP protocol address'),
         'ssdp_port': dict(default=1900, help='Yamaha SSDP port', type=int),
+        'pipeline' : dict(default=1, help='Max number of pipelined requests to Yamaha', type=int),
+        'batch'    : dict(default=8, help='Max number of commands merged in one request', type=int),
     }
 
+    # Time to collect notifications before fetching the changed state
+    notify_window = 0.5
+
+    # --- Initialization
+    def __init__(self):
+        self.state = {}
+        self.pending = set()
+        self.notify_timer = None
+
+
     # --- Interfaces
     def configure(self):
 
@@ -427,9 +812,9 @@ class Yamaha(Node):
             #'avr/stopping',      # close() have been called
             #'avr/error',         # Connection failed
 
-            #'avr/volume',        # Volume event
-            #'avr/input',         # Input change event
-            #'avr/power',         # Change in power
+            'volume',             # Volume event
+            'input',              # Input change event
+            'power',              # Change in power
         )
 
         self.commands = {
@@ -468,7 +853,10 @@ class Yamaha(Node):
         self.ssdp_host = self.master.config.get('ssdp', name=self.name)
         self.ssdp_port = self.master.config.get('ssdp_port', name=self.name)
 
-        self.protocol = YamahaProtocol(self, self.host, self.port)
+        self.pipeline = self.master.config.get('pipeline', name=self.name)
+        self.batch = self.master.config.get('batch', name=self.name)
+
+        self.protocol = YamahaProtocol(self, self.host, self.port, self.pipeline, self.batch)
         self.ssdp = YamahaSSDP(self, self.host, self.ssdp_host)
 
         self.master.reactor.listenMulticast(self.ssdp_port, self.ssdp, listenMultiple=True)
@@ -480,6 +868,9 @@ class Yamaha(Node):
 
     def close(self):
         Node.close(self)
+        if self.notify_timer:
+            self.notify_timer.cancel()
+            self.notify_timer = None
         self.protocol.disconnect()
         self.ssdp.disconnect()
 
@@ -492,13 +883,43 @@ class Yamaha(Node):
     # --- Callbacks
     def notification(self, notifications):
         self.status.set_GREEN()
-        self.log.info("Got notifications: {n}", n=notifications)
-        #if 'Volume' in notifications:
-        #    self.get_command('avr/volume')(None).addCallback(self.event_as_arg, 'avr/volume')
-        #if 'Input' in notifications:
-        #    self.get_command('avr/input')(None).addCallback(self.event_as_arg, 'avr/input')
-        #if 'Power' in notifications:
-        #    self.get_command('avr/ison')(None).addCallback(self.event_as_arg, 'avr/ison')
+        self.log.debug("Got notifications: {n}", n=notifications)
+
+        # The notified properties have changed on the device
+        for prop in notifications:
+            chains = NOTIFICATIONS.get(prop)
+            if chains is None:
+                self.protocol.invalidate()
+                break
+            self.protocol.invalidate(*chains)
+
+        # The device sends bursts of notifications, e.g. when turning the
+        # volume. Collect them and fetch the changed state once.
+        self.pending.update(notifications)
+        if self.notify_timer is None:
+            self.notify_timer = self.master.reactor.callLater(self.notify_window, self.refresh)
+
+
+    def refresh(self):
+        ''' Fetch the state of the notified properties '''
+        self.notify_timer = None
+        (pending, self.pending) = (self.pending, set())
+        for prop in pending:
+            if prop not in STATE_EVENTS:
+                continue
+            (event, chain, parse) = STATE_EVENTS[prop]
+            defer = self.c(GET, chain, priority=PRIO_LOW, cached=False)
+            defer.addCallback(parse)
+            defer.addCallback(self.update_state, event)
+            defer.addErrback(lambda a: None)
+
+
+    def update_state(self, value, event):
+        ''' Send the state event if the value has changed '''
+        if self.state.get(event, MISSING) == value:
+            return
+        self.state[event] = value
+        self.sendEvent(event, value)
 
 
 
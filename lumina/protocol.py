@@ -8,8 +8,10 @@ from twisted.protocols.basic import LineReceiver
 from twisted.internet.defer import Deferred, maybeDeferred
 from twisted.internet.task import LoopingCall
 
+from lumina.log import LogLevel
 from lumina.message import Message
-from lumina.utils import add_defer_timeout
+from lumina.codec import JsonCodec, codec_names, get_codec, select_codec
+from lumina.timingwheel import TimingWheel
 from lumina.exceptions import (NodeException, NoConnectionException,
                                TimeoutException, UnknownMessageException,
                                UnknownCommandException, NodeRegistrationException)
@@ -37,6 +39,7 @@ from lumina.state import ColorState
 #
 #    3. If message.requestid is not None on an incoming request
 #        - A response is requested using same requestid
+#        - The requestid is unique only within the connection
 #        - The receiver will call message.defer on the original
 #          request with incoming results
 #
@@ -44,6 +47,23 @@ from lumina.state import ColorState
 #        * register - Register node (client) capability
 #        * status - Report node status to server
 #
+#    5. Wire codec negotiation. All connections start out as newline
+#       delimited JSON (see codec.py):
+#        * '_codecs' - Request sent by both sides on connect, listing the
+#                      codecs it can decode in order of preference. The
+#                      peer replies before sending '_codec'.
+#        * '_codec'  - Sent in response to '_codecs'. All data sent after
+#                      this message is encoded using the named codec.
+#       Each direction is negotiated independently. Peers not supporting
+#       negotiation fail '_codecs' as an unknown command, and log it. The
+#       error reply is accepted silently, and the link stays JSON.
+#
+#    6. Batching. Messages can be sent together in one '_batch' message of
+#       type 'batch', where args is the list of messages. The receiver
+#       processes each message in order, as if they were sent separately.
+#       Batches are only sent if enabled and if the peer has sent
+#       '_codecs', which indicates that it is able to receive batches.
+#
 
 # FIXME: Add this as a config statement
 
@@ -54,6 +74,12 @@ COMMAND_TIMEOUT = 10
 # The interval to send empty messages to server to keep the link alive
 KEEPALIVE_INTERVAL = 60
 
+# The resolution of the request timeouts
+TIMEOUT_RESOLUTION = 0.5
+
+# Maximum number of messages in a batch
+BATCH_MAX = 32
+
 
 # Exception types that will not result in a local traceback
 VALID_NODE_EXCEPTIONS = (
@@ -73,6 +99,12 @@ class LuminaProtocol(LineReceiver):
     command_timeout = COMMAND_TIMEOUT
     keepalive_interval = KEEPALIVE_INTERVAL
 
+    # Batching of outgoing messages. batch_window is the time in seconds to
+    # collect messages before sending them, 0 is the current reactor tick.
+    batch = False
+    batch_window = 0.0
+    batch_max = BATCH_MAX
+
 
     def __init__(self, parent, sequence=1):
         self.parent = parent
@@ -97,6 +129,20 @@ class LuminaProtocol(LineReceiver):
         self.peer = ''
         self.name = ''
         self.requests = {}
+        self.lastrequestid = 0
+
+        # -- One common timer for all request and command timeouts
+        self.timeouts = TimingWheel(self.master.reactor,
+                                    resolution=TIMEOUT_RESOLUTION, log=self.log)
+
+        # -- Codecs for outgoing and incoming data
+        self.txcodec = JsonCodec()
+        self.rxcodec = JsonCodec()
+
+        # -- Outgoing batch
+        self.txbatch = []
+        self.txbatch_timer = None
+        self.peer_batch = False
 
 
     def connectionMade(self):
@@ -110,8 +156,19 @@ class LuminaProtocol(LineReceiver):
         self.lastactivity = datetime.utcnow()
         self.connected = True
 
-        # Clear the dict of pending requests
+        # Clear the dict of pending requests. Request ids starts over on
+        # each connection.
         self.requests = {}
+        self.lastrequestid = 0
+
+        # -- All connections start out with JSON. Offer the codecs to the
+        #    peer, which also tells the peer that we accept batches.
+        self.txcodec = JsonCodec()
+        self.rxcodec = JsonCodec()
+        self.txbatch = []
+        self.peer_batch = False
+        defer = self.send(Message.create('command', '_codecs', *codec_names()))
+        defer.addErrback(self.codecsRefused)
 
         # -- Setup a keepalive timer
         self.keepalive = LoopingCall(self.keepalivePing)
@@ -129,8 +186,16 @@ class LuminaProtocol(LineReceiver):
         if self.keepalive and self.keepalive.running:
             self.keepalive.stop()
 
+        # -- Drop any unsent batch
+        if self.txbatch_timer and self.txbatch_timer.active():
+            self.txbatch_timer.cancel()
+        self.txbatch_timer = None
+        self.txbatch = []
+
         # -- Cancel any pending requests
-        for (requestid, request) in self.requests.items():  # pylint: disable=unused-variable
+        (requests, self.requests) = (self.requests, {})
+        for (requestid, request) in requests.items():
+            self.timeouts.remove(requestid)
             exc = NoConnectionException()
             request.set_fail(exc)
 
@@ -143,10 +208,34 @@ class LuminaProtocol(LineReceiver):
     def keepalivePing(self):
         ''' Handle a keepalive event
         '''
-        self.transport.write('\n')
+        self.transport.write(self.txcodec.keepalive())
 
 
     def lineReceived(self, data):  # pylint: disable=W0221
+        self.frameReceived(data)
+
+
+    def rawDataReceived(self, data):
+        ''' Handle incoming data when using a binary codec '''
+
+        # -- Any data counts as activity, including keepalive frames
+        if self.keepalive and self.keepalive.running:
+            self.keepalive.reset()
+
+        try:
+            frames = self.rxcodec.unframe(data)
+        except ValueError as err:
+            # The stream cannot be resynchronized, so drop the connection
+            self.log.error("Protocol error on incoming data: {e}", e=str(err))
+            self.transport.loseConnection()
+            return
+
+        for frame in frames:
+            self.frameReceived(frame)
+
+
+    def frameReceived(self, data):
+        ''' Handle one incoming frame of data '''
 
         # -- Reset the timer
         if self.keepalive and self.keepalive.running:
@@ -156,18 +245,32 @@ class LuminaProtocol(LineReceiver):
         if not data:
             return
 
-        self.log.debug('{_rawin}', rawin=data)
+        if self.log.isEnabled(LogLevel.debug, 'rawin'):
+            self.log.debug('{_rawin}', rawin=data)
 
         # -- Parse the incoming message
         try:
-            message = Message.create_from_json(data)
-            self.log.debug('{_cmdin}', cmdin=message)
+            message = self.rxcodec.decode(data)
 
         except (SyntaxError, ValueError) as err:
             # Raised if the load_json didn't succeed
             self.log.error("Protocol error on incoming message: {e}", e=str(err))
             return
 
+        # -- Unpack batches and process the messages in order
+        if message.is_type('batch'):
+            for submessage in message.args:
+                self.dispatchMessage(submessage)
+            return
+
+        self.dispatchMessage(message)
+
+
+    def dispatchMessage(self, message):
+        ''' Handle one incoming message '''
+        if self.log.isEnabled(LogLevel.debug, 'cmdin'):
+            self.log.debug('{_cmdin}', cmdin=message)
+
         # -- Update the activity timer
         self.lastactivity = datetime.utcnow()
 
@@ -184,6 +287,18 @@ class LuminaProtocol(LineReceiver):
             self.handleResponse(message)
             return
 
+        # -- Handle codec negotiation messages. The reply to the offer must
+        #    be sent before switching codec.
+        if message.name == '_codecs':
+            names = message.args
+            if message.requestid is not None:
+                self.writeFrame(message.set_success(None))
+            self.codecsOffered(names)
+            return
+        if message.name == '_codec':
+            self.codecSelected(message.args[0] if message.args else None)
+            return
+
         # -- New incoming message:
         #
         #    Call the dispatcher with a copy of our message. Want the
@@ -194,7 +309,8 @@ class LuminaProtocol(LineReceiver):
         def msg_ok(result):
             ''' Command ok handler '''
             message.set_success(result)
-            self.log.debug('{_cmdok}', cmdok=message)
+            if self.log.isEnabled(LogLevel.debug, 'cmdok'):
+                self.log.debug('{_cmdok}', cmdok=message)
             return result
 
         def msg_error(failure):
@@ -223,7 +339,7 @@ class LuminaProtocol(LineReceiver):
 
         # -- Setup a timeout, and add a timeout err handler making sure the
         #    message data failure is properly set
-        add_defer_timeout(self.master.reactor, defer, self.command_timeout, msg_timeout)
+        self.timeouts.add_defer_timeout(defer, self.command_timeout, msg_timeout)
 
         defer.addCallback(msg_ok)
         defer.addErrback(msg_error)
@@ -247,6 +363,7 @@ class LuminaProtocol(LineReceiver):
 
         # Get orginial request and delete it from the queue.
         request = self.requests.pop(message.requestid)
+        self.timeouts.remove(message.requestid)
         #self.log.debug("       ^^ is a reply to {re}", re=request)
 
         # Link the request with the response by copying the
@@ -264,7 +381,7 @@ class LuminaProtocol(LineReceiver):
         # Get the defer handler and remove it from the request to prevent
         # calling it twice. Delete other modification from the request object
         defer = request.defer
-        del request.defer
+        request.defer = None
         request.requestid = None
         #request.args = None  # Might not be a good idea to remove the args
                               # from the request since ideally the the original
@@ -274,7 +391,8 @@ class LuminaProtocol(LineReceiver):
         if message.response:
 
             # Send successful result back
-            self.log.debug('{_cmdok}', cmdok=message)
+            if self.log.isEnabled(LogLevel.debug, 'cmdok'):
+                self.log.debug('{_cmdok}', cmdok=message)
             if not defer.called:
 
                 # Been back and forth between sending 'message' or
@@ -316,9 +434,11 @@ class LuminaProtocol(LineReceiver):
             # Add an eat-error message to the end of the chain
             defer.addErrback(response_error)
 
-            # Send an error back
+            # Send an error back. Peers not supporting codec negotiation
+            # fail the codec offer, which is handled by codecsRefused().
             exc = NodeException(*message.result)
-            self.log.error('REMOTE FAILED: {r} RETURNED {m}', r=request, m=message)
+            if request.name != '_codecs':
+                self.log.error('REMOTE FAILED: {r} RETURNED {m}', r=request, m=message)
             if not defer.called:
                 defer.errback(exc)
             else:
@@ -326,6 +446,50 @@ class LuminaProtocol(LineReceiver):
                                'called. Timeout?')
 
 
+    def codecsOffered(self, names):
+        ''' Handle the list of codecs the peer is able to decode. Select the
+            preferred codec and tell the peer before switching to it.
+        '''
+        self.peer_batch = True
+        codec = select_codec(names)
+        if codec.name == self.txcodec.name:
+            return
+        self.log.info("Using codec '{c}' for outgoing data", c=codec.name)
+
+        # Anything batched must be sent with the old codec
+        self.flushBatch()
+        self.writeFrame(Message.create('command', '_codec', codec.name))
+        self.txcodec = codec
+
+
+    def codecsRefused(self, failure):
+        ''' Handle the failure of the codec offer. The peer does not support
+            codec negotiation, so the link stays JSON.
+        '''
+        self.log.debug("Peer does not support codec negotiation: {e}",
+                       e=failure.getErrorMessage())
+
+
+    def codecSelected(self, name):
+        ''' Handle the peer's notification that it will send any
+            subsequent data using the named codec.
+        '''
+        try:
+            codec = get_codec(name)
+        except ValueError as err:
+            self.log.error("Peer selected unsupported codec: {e}", e=str(err))
+            self.transport.loseConnection()
+            return
+        self.log.info("Using codec '{c}' for incoming data", c=codec.name)
+        self.rxcodec = codec
+        if codec.framed:
+            # Any remaining data in the line buffer will be passed on to
+            # rawDataReceived() when lineReceived() returns
+            self.setRawMode()
+        else:
+            self.setLineMode()
+
+
     def messageReceived(self, message):  # pylint: disable=R0201
         ''' Process an incoming message. This method should return
             a Deferred() if results are not immediately available
@@ -348,26 +512,71 @@ class LuminaProtocol(LineReceiver):
             # -- Generate a deferred object
             message.defer = defer = Deferred()
 
-            def send_timeout(message):
-                ''' Failure if remote command suffers a timeout '''
-                self.link.set_YELLOW('Communication timeout')
-                self.requests.pop(message.requestid)
-                exc = TimeoutException()
-                message.set_fail(exc)
-                message.defer.errback(exc)
-
-            # -- Setup a timeout, and add a timeout err handler making sure the
-            #    message data failure is properly set
-            add_defer_timeout(self.master.reactor, defer, self.remote_timeout,
-                              send_timeout, message)
-
             # -- Generate new requestid for message, save message in request list
-            self.requests[message.get_requestid()] = message
+            self.lastrequestid += 1
+            requestid = message.requestid = self.lastrequestid
+            self.requests[requestid] = message
+
+            # -- Setup a timeout, which is removed when the response arrives
+            self.timeouts.add(requestid, self.remote_timeout,
+                              self.sendTimeout, requestid)
 
         # -- Encode and send the command
-        self.log.debug('{_cmdout}', cmdout=message)
-        data = message.dump_json()
-        self.log.debug('{_rawout}', rawout=data)
-        self.transport.write(data+'\n')
+        self.writeMessage(message)
 
         return defer
+
+
+    def sendTimeout(self, requestid):
+        ''' Failure if remote command suffers a timeout '''
+        message = self.requests.pop(requestid, None)
+        if message is None:
+            return
+        self.link.set_YELLOW('Communication timeout')
+        exc = TimeoutException()
+        message.set_fail(exc)
+        message.defer.errback(exc)
+
+
+    def writeMessage(self, message):
+        ''' Write the message to the peer. If batching is enabled, the
+            message is added to the outgoing batch.
+        '''
+        if self.log.isEnabled(LogLevel.debug, 'cmdout'):
+            self.log.debug('{_cmdout}', cmdout=message)
+
+        if not (self.batch and self.peer_batch):
+            self.writeFrame(message)
+            return
+
+        self.txbatch.append(message)
+        if len(self.txbatch) >= self.batch_max:
+            self.flushBatch()
+        elif self.txbatch_timer is None:
+            self.txbatch_timer = self.master.reactor.callLater(self.batch_window,
+                                                               self.flushBatch)
+
+
+    def flushBatch(self):
+        ''' Send any messages in the outgoing batch '''
+        if self.txbatch_timer and self.txbatch_timer.active():
+            self.txbatch_timer.cancel()
+        self.txbatch_timer = None
+
+        (batch, self.txbatch) = (self.txbatch, [])
+        if not batch:
+            return
+        if len(batch) == 1:
+            self.writeFrame(batch[0])
+        else:
+            self.writeFrame(Message.create('batch', '_batch', *batch))
+
+
+    def writeFrame(self, message):
+        ''' Encode and write the message to the transport using the current
+            outgoing codec.
+        '''
+        data = self.txcodec.encode(message)
+        if self.log.isEnabled(LogLevel.debug, 'rawout'):
+            self.log.debug('{_rawout}', rawout=data)
+        self.transport.write(data)
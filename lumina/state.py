@@ -16,6 +16,59 @@ from lumina.log import Logger
 #    halted    failed state
 
 
+class StateCallback(object):
+    ''' Delayed delivery of State changes to callback. The changes within
+        'window' seconds are collapsed into one call with the final state,
+        where a window of 0 collapses the changes within the current reactor
+        tick. The calls are made at least 'interval' seconds apart. A change
+        back to the last delivered state is not delivered.
+    '''
+
+    def __init__(self, reactor, callback, window=0, interval=0):
+        self.reactor = reactor
+        self.callback = callback
+        self.window = window
+        self.interval = interval
+        self.timer = None
+        self.state = None
+        self.last = None
+        self.lastcall = None
+
+
+    def __call__(self, state):
+        self.state = state
+        if self.timer is not None:
+            return
+        delay = self.window
+        if self.lastcall is not None:
+            delay = max(delay, self.lastcall + self.interval - self.reactor.seconds())
+        self.timer = self.reactor.callLater(delay, self.deliver)
+
+
+    def deliver(self):
+        ''' Deliver the pending change '''
+        self.timer = None
+        if (self.state.state, self.state.why) != self.last:
+            self.fire(self.state)
+
+
+    def fire(self, state):
+        ''' Deliver state now '''
+        self.cancel()
+        self.state = state
+        self.last = (state.state, state.why)
+        self.lastcall = self.reactor.seconds()
+        self.callback(state)
+
+
+    def cancel(self):
+        ''' Cancel any pending delivery '''
+        if self.timer is not None and self.timer.active():
+            self.timer.cancel()
+        self.timer = None
+
+
+
 class State(object):
     ''' Class for keeping a state variable. States can be set using
         set(state, *args), and read with get(). It will log an entry when the
@@ -41,10 +94,27 @@ class State(object):
         self.quiet = quiet
 
 
-    def add_callback(self, callback, run_now=False):
+    def add_callback(self, callback, run_now=False, reactor=None, window=None, interval=0):
+        ''' Add callback to be run on changes. If window is set, the changes
+            are delivered through a StateCallback using reactor. Returns the
+            registered callback.
+        '''
+        if window is not None:
+            callback = StateCallback(reactor, callback, window=window, interval=interval)
         self.callbacks.append(callback)
         if run_now:
-            callback(self)
+            if window is not None:
+                callback.fire(self)
+            else:
+                callback(self)
+        return callback
+
+
+    def remove_callback(self, callback):
+        ''' Remove the callback returned from add_callback() '''
+        self.callbacks.remove(callback)
+        if isinstance(callback, StateCallback):
+            callback.cancel()
 
 
     def set(self, state, why=None):
@@ -137,3 +207,178 @@ class ColorState(State):
                     ]) + ' is OFF')
             why = ". ".join(whys)
         return (status, why)
+
+
+
+# Marker for values missing from the StateCache
+MISSING = object()
+
+
+class StateCache(object):
+    ''' Mirror of the last confirmed state values of a device, stored by a
+        hashable key, e.g. an item or a command chain. A value expires after
+        'lifetime' seconds, as the device might have been changed by other
+        means. Commands setting a value the device is known to have can be
+        skipped by checking is_set().
+    '''
+
+    def __init__(self, reactor, lifetime=None):
+        self.reactor = reactor
+        self.lifetime = lifetime
+        self.values = {}
+
+
+    def get(self, key, default=None):
+        ''' Return the value of key if known, otherwise default '''
+        entry = self.values.get(key)
+        if entry is None:
+            return default
+        (value, expires) = entry
+        if expires is not None and self.reactor.seconds() >= expires:
+            del self.values[key]
+            return default
+        return value
+
+
+    def set(self, key, value):
+        ''' Set key to the confirmed device value '''
+        expires = None
+        if self.lifetime is not None:
+            expires = self.reactor.seconds() + self.lifetime
+        self.values[key] = (value, expires)
+
+
+    def is_set(self, key, value):
+        ''' Return True if key is known to be value '''
+        return self.get(key, MISSING) == value
+
+
+    def invalidate(self, *keys):
+        ''' Forget the given keys, or all values if no keys are given '''
+        if not keys:
+            self.values.clear()
+        for key in keys:
+            self.values.pop(key, None)
+
+
+
+class ColorStateWhy(object):
+    ''' The text explaining the state of a ColorStateAggregate. The text is
+        made by the aggregate when it is converted to a string.
+    '''
+    __slots__ = ('aggregate', 'version')
+
+    def __init__(self, aggregate, version):
+        self.aggregate = aggregate
+        self.version = version
+
+    def __str__(self):
+        return self.aggregate.why()
+
+    def __eq__(self, other):
+        return (isinstance(other, ColorStateWhy) and self.aggregate is other.aggregate
+                and self.version == other.version)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((id(self.aggregate), self.version))
+
+
+
+class ColorStateAggregate(object):
+    ''' Incremental variant of ColorState.combine(). The members are counted
+        by their state, and the counts are updated when a member changes
+        state, so the combined state is found without visiting all members.
+        The text explaining the state is made when it is read.
+    '''
+
+    def __init__(self):
+        self.members = {}
+        self.colors = {'OFF': set(), 'YELLOW': set(), 'RED': set(), 'GREEN': set()}
+        self.version = 0
+        self.whytext = (None, None)
+
+
+    def __len__(self):
+        return len(self.members)
+
+
+    def add(self, member):
+        ''' Add the ColorState member '''
+        self.remove(member)
+        self.members[member] = member.state
+        self.colors[member.state].add(member)
+        self.version += 1
+
+
+    def remove(self, member):
+        ''' Remove member. Returns False if it is not a member. '''
+        state = self.members.pop(member, None)
+        if state is None:
+            return False
+        self.colors[state].discard(member)
+        self.version += 1
+        return True
+
+
+    def update(self, member):
+        ''' Update the state of member. Returns True if the state has changed.
+            Objects which are not members are ignored.
+        '''
+        old = self.members.get(member)
+        state = member.state
+        if old is None or old == state:
+            return False
+        self.colors[old].discard(member)
+        self.colors[state].add(member)
+        self.members[member] = state
+        self.version += 1
+        return True
+
+
+    @property
+    def state(self):
+        ''' The combined state '''
+        colors = self.colors
+        count = len(self.members)
+        if colors['RED']:
+            return 'RED'
+        elif len(colors['GREEN']) == count:
+            return 'GREEN'
+        elif len(colors['OFF']) == count:
+            return 'OFF'
+        return 'YELLOW'
+
+
+    def combine(self):
+        ''' Return the combined (state, why) like ColorState.combine() '''
+        state = self.state
+        if state in ('GREEN', 'OFF'):
+            return (state, None)
+        return (state, ColorStateWhy(self, self.version))
+
+
+    def why(self):
+        ''' Return the text explaining the combined state '''
+        (version, text) = self.whytext
+        if version == self.version:
+            return text
+
+        def names(state):
+            return ', '.join(sorted(s.name or '' for s in self.colors[state]))
+
+        colors = self.colors
+        text = None
+        if colors['RED']:
+            text = '(%s) ' %(len(colors['RED'])) + names('RED') + ' is RED'
+        elif self.state == 'YELLOW':
+            whys = []
+            if colors['YELLOW']:
+                whys.append(names('YELLOW') + ' is YELLOW')
+            if colors['OFF']:
+                whys.append(names('OFF') + ' is OFF')
+            text = ". ".join(whys)
+        self.whytext = (self.version, text)
+        return text
@@ -8,6 +8,7 @@ from zope.interface import implementer
 from twisted.logger import ILogObserver
 from twisted.logger import LogLevel
 from twisted.logger import formatEvent
+from twisted.logger import formatTime
 
 
 # These defaults come from the Python syslog docs.
@@ -45,11 +46,20 @@ class SyslogObserver(object):
         """
         Write event to syslog.
         """
+        record = self.format(event)
+        if record is not None:
+            self.write([record])
+
+
+    def format(self, event):
+        """
+        Return the syslog record of event, or None if it has no text.
+        """
 
         # Figure out what the message-text is.
         eventText = formatEvent(event)
         if eventText is None:
-            return
+            return None
 
         # Figure out what syslog parameters we might need to use.
         level = event.get("log_level", None)
@@ -61,16 +71,37 @@ class SyslogObserver(object):
         priority = LOGLEVEL_MAP[level]
         facility = int(event.get('log_facility', DEFAULT_FACILITY))
 
-        # Break the message up into lines and send them.
-        lines = eventText.split('\n')
-        while lines[-1:] == ['']:
-            lines.pop()
+        return (priority | facility, event.get('log_system', '-'), eventText,
+                event.get('log_time', None))
 
-        firstLine = True
-        for line in lines:
-            if firstLine:
-                firstLine = False
-            else:
-                line = '        ' + line
-            self.syslog(priority | facility,
-                        '[%s] %s' % (event.get('log_system', '-'), line))
+
+    def text(self, record):
+        """
+        Return the record as a line of human-readable text.
+        """
+        (priority, system, eventText, logTime) = record
+        return u"{timeStamp} [{system}]  {event}\n".format(
+            timeStamp=formatTime(logTime),
+            system=system,
+            event=eventText.replace(u"\n", u"\n\t"),
+        )
+
+
+    def write(self, records):
+        """
+        Write the records to syslog.
+        """
+        for (priority, system, eventText, logTime) in records:
+
+            # Break the message up into lines and send them.
+            lines = eventText.split('\n')
+            while lines[-1:] == ['']:
+                lines.pop()
+
+            firstLine = True
+            for line in lines:
+                if firstLine:
+                    firstLine = False
+                else:
+                    line = '        ' + line
+                self.syslog(priority, '[%s] %s' % (system, line))
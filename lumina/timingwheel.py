@@ -0,0 +1,145 @@
+# -*- python -*-
+""" Hashed timing wheel for handling large numbers of timeouts """
+from __future__ import absolute_import, division, print_function
+
+import math
+
+from twisted.internet.task import LoopingCall
+
+from lumina.log import Logger
+
+
+class TimingWheel(object):
+    ''' A hashed timing wheel. It keeps any number of pending timeouts using
+        one single reactor timer, which is only running when there are
+        entries in the wheel. Timeouts are rounded up to the nearest
+        'resolution' seconds, and all timeouts expiring on the same tick are
+        run in one batch. Adding and removing entries are O(1).
+
+        Entries are identified by a hashable key, which must be unique
+        within the wheel. Adding an existing key will replace the old entry.
+    '''
+
+    def __init__(self, reactor, resolution=0.5, size=64, log=None):
+        self.reactor = reactor
+        self.resolution = resolution
+        self.size = size
+        if log is None:
+            self.log = Logger()
+        else:
+            self.log = log
+
+        # Each slot is a dict of key -> (tick, callback, args, kw)
+        self.slots = [{} for _ in range(size)]
+
+        # Index of key -> slot number
+        self.entries = {}
+
+        # The last processed tick
+        self.tick = 0
+        self.timer = None
+
+
+    def __len__(self):
+        return len(self.entries)
+
+
+    def __contains__(self, key):
+        return key in self.entries
+
+
+    def add(self, key, timeout, callback, *args, **kw):
+        ''' Add a timeout entry which will call callback(*args, **kw) after
+            timeout seconds, unless it is removed before.
+        '''
+        if key in self.entries:
+            self.remove(key)
+
+        if self.timer is None:
+            self.start()
+
+        tick = int(math.ceil((self.reactor.seconds() + timeout) / self.resolution))
+        tick = max(tick, self.tick + 1)
+        slot = tick % self.size
+        self.slots[slot][key] = (tick, callback, args, kw)
+        self.entries[key] = slot
+
+
+    def remove(self, key):
+        ''' Remove the timeout entry given by key. Returns True if the
+            entry was present.
+        '''
+        slot = self.entries.pop(key, None)
+        if slot is None:
+            return False
+        del self.slots[slot][key]
+        if not self.entries:
+            self.stop()
+        return True
+
+
+    def clear(self):
+        ''' Remove all the entries '''
+        for slot in self.slots:
+            slot.clear()
+        self.entries.clear()
+        self.stop()
+
+
+    def add_defer_timeout(self, defer, timeout, callback, *args, **kw):
+        ''' Add a timeout to the defer object, in the same fashion as
+            lumina.utils.add_defer_timeout(). The defer object itself is
+            used as key, and the entry is removed when the defer fires.
+        '''
+        self.add(defer, timeout, callback, *args, **kw)
+
+        def timeout_cancel(result):
+            ''' Remove the timeout if it has not been fired '''
+            self.remove(defer)
+            return result
+
+        defer.addBoth(timeout_cancel)
+
+
+    def start(self):
+        ''' Start the wheel timer '''
+        self.tick = int(self.reactor.seconds() / self.resolution)
+        self.timer = LoopingCall(self.advance)
+        self.timer.clock = self.reactor
+        self.timer.start(self.resolution, now=False)
+
+
+    def stop(self):
+        ''' Stop the wheel timer '''
+        if self.timer is not None:
+            if self.timer.running:
+                self.timer.stop()
+            self.timer = None
+
+
+    def advance(self):
+        ''' Process all slots up to the current time and run the callbacks
+            of the expired entries.
+        '''
+        now = int(self.reactor.seconds() / self.resolution)
+
+        # Only visit each slot once, even if the reactor has been stalled
+        # for more than one revolution of the wheel
+        expired = []
+        for tick in range(self.tick + 1, self.tick + 1 + min(now - self.tick, self.size)):
+            slot = self.slots[tick % self.size]
+            if not slot:
+                continue
+            for key in [k for k, v in slot.items() if v[0] <= now]:
+                expired.append(slot.pop(key))
+                del self.entries[key]
+        self.tick = max(now, self.tick)
+
+        if not self.entries:
+            self.stop()
+
+        for (tick, callback, args, kw) in expired:  # pylint: disable=unused-variable
+            try:
+                callback(*args, **kw)
+            except Exception:   # pylint: disable=broad-except
+                self.log.failure("Timeout callback failed")
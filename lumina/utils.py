@@ -2,6 +2,10 @@
 """ Utility and helper functions """
 from __future__ import absolute_import, division, print_function
 
+import os
+import json
+from binascii import hexlify
+
 from twisted.internet.protocol import Factory
 
 
@@ -93,6 +97,52 @@ def connectProtocol(endpoint, protocol):
     return endpoint.connect(OneShotFactory())
 
 
+class Snapshot(object):
+    ''' Cached result of build() and its JSON encoding. version() returns the
+        version of the underlying data, and the snapshot is rebuilt on the
+        first use after the version has changed. The entity tag identifies
+        the snapshot contents, and is unique across restarts.
+    '''
+
+    def __init__(self, build, version):
+        self.build = build
+        self.version = version
+        self.nonce = hexlify(os.urandom(4)).decode('ascii')
+        self.serial = 0
+        self.current = None
+        self.data = None
+        self.encoded = None
+        self.tag = None
+
+
+    def refresh(self):
+        ''' Rebuild the snapshot if the version has changed '''
+        version = self.version()
+        if self.data is None or version != self.current:
+            self.data = self.build()
+            self.current = version
+            self.serial += 1
+            self.encoded = None
+            self.tag = None
+
+
+    def get(self):
+        ''' Return the snapshot data '''
+        self.refresh()
+        return self.data
+
+
+    def json(self):
+        ''' Return the tuple (etag, json) of the snapshot. The JSON is only
+            encoded once per snapshot.
+        '''
+        self.refresh()
+        if self.encoded is None:
+            self.encoded = json.dumps(self.data).encode('utf-8')
+            self.tag = ('"%s-%s"' %(self.nonce, self.serial)).encode('ascii')
+        return (self.tag, self.encoded)
+
+
 # Written by Stephen McDonald, copied from
 # http://blog.jupo.org/2012/04/06/topological-sorting-acyclic-directed-graphs/
 def topolgical_sort(graph):
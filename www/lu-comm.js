@@ -36,22 +36,53 @@ angular.module('LuminaApp')
                 });
         };
 
+        // Info from the REST interface. The browser revalidates the
+        // cached replies using the ETag of the info.
+        var info = function(path) {
+            return $http.get('/rest/info/' + path)
+                .then(function(response) {
+                    return response.data;
+                });
+        };
+
+        // Push channel. Opens the event stream with the given topic filters,
+        // and calls handlers[event](topic, data) for each message, where
+        // event is the first element of the topic. handlers.open is called
+        // on every (re)connect, as messages may have been lost meanwhile.
+        var stream = function(filters, handlers) {
+            var source = new EventSource('/rest/stream?filter=' +
+                                         encodeURIComponent(filters.join(',')));
+            source.onopen = function() {
+                if (handlers.open) {
+                    handlers.open();
+                }
+            };
+            Object.keys(handlers).forEach(function(event) {
+                if (event == 'open') {
+                    return;
+                }
+                source.addEventListener(event, function(e) {
+                    var msg = JSON.parse(e.data || '{}');
+                    handlers[event](msg.topic, msg.data);
+                });
+            });
+            return source;
+        };
+
         // Admin functions
         var get_server_info = function() {
-            return command('_server');
+            return info('_server');
         }
 
         var get_host_info = function(node='') {
-            if (node.length>0) {
-                node = node + '/';
-            }
-            return command(node + '_info');
+            return info(node);
         }
 
         // Functions
         return {
             debug: debug,
             command: command,
+            stream: stream,
 
             get_server_info: get_server_info,
             get_host_info: get_host_info,
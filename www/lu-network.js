@@ -67,6 +67,64 @@ angular.module('LuminaApp')
                 });
         };
 
+        // Receive status and node changes pushed from the server. Reload
+        // everything on (re)connect and when the server lost messages. The
+        // reload is cheap, as unchanged info is revalidated by its ETag.
+        var stream = LuminaComm.stream(['status', 'node_status', 'plugin/*', 'node/*'], {
+            open: function() {
+                $scope.$apply(on_page_load);
+            },
+            overflow: function() {
+                $scope.$apply(on_page_load);
+            },
+            node: function(topic, data) {
+                $scope.$apply(function() {
+                    if (!$scope.nodes) {
+                        return;
+                    }
+                    for (let i=0; i < $scope.nodes.length; i++) {
+                        if ($scope.nodes[i].name == data.name) {
+                            $scope.nodes[i] = data;
+                            return;
+                        }
+                    }
+                    $scope.nodes.push(data);
+                });
+            },
+            node_status: function(topic, data) {
+                $scope.$apply(function() {
+                    if ($scope.server) {
+                        $scope.server.node_status = data.status;
+                        $scope.server.node_status_why = data.status_why;
+                    }
+                });
+            },
+            status: function(topic, data) {
+                $scope.$apply(function() {
+                    if ($scope.master) {
+                        $scope.master.status = data.status;
+                        $scope.master.status_why = data.status_why;
+                    }
+                });
+            },
+            plugin: function(topic, data) {
+                $scope.$apply(function() {
+                    let name = topic.slice('plugin/'.length);
+                    let plugins = $scope.master ? $scope.master.plugins : [];
+                    for (let i=0; i < plugins.length; i++) {
+                        if (plugins[i].name == name) {
+                            plugins[i].status = data.status;
+                            plugins[i].status_why = data.status_why;
+                        }
+                    }
+                });
+            },
+        });
+
+        $scope.$on('$destroy', function() {
+            stream.close();
+        });
+
         $scope.on_select_host = function(hostid) {
             if (hostid) {
                 $scope.selected_host = $scope.hosts[hostid];